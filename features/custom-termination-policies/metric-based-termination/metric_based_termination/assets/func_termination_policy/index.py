@@ -1,6 +1,26 @@
 import boto3
 import datetime
+import json
 import os
+import random
+import threading
+import time
+import warnings
+import zlib
+
+from collections import OrderedDict
+from urllib.parse import quote
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# NumPy is only required by the weighted scoring and the series sampling, it can be provided with a Lambda layer
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Available metrics: https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/viewing_metrics_with_cloudwatch.html
 
@@ -11,9 +31,424 @@ METRIC_TIME_WINDOW_IN_MINUTES = int(                        # Time window for re
     os.getenv('METRIC_TIME_WINDOW_IN_MINUTES')
 )
 
-METRICS = [
-    METRIC_NAME
+METRIC_NAMESPACE = 'AWS/EC2'                                # Namespace of the metrics
+METRIC_FETCH_MODE = os.getenv(                              # Either 'instance' for one query per instance and metric
+    'METRIC_FETCH_MODE', 'instance'                         # or 'search' for one SEARCH expression per metric
+)
+
+METRIC_SAMPLING = os.getenv(                                # Either 'window' for one data point per time window
+    'METRIC_SAMPLING', 'window'                             # or 'series' for one data point per METRIC_PERIOD_IN_SECONDS
+)
+METRIC_PERIOD_IN_SECONDS = int(                             # Period of the data points retrieved by the series sampling
+    os.getenv('METRIC_PERIOD_IN_SECONDS', '60')
+)
+METRIC_PERCENTILE = float(                                  # Percentile of the data points used as the value of a metric
+    os.getenv('METRIC_PERCENTILE', '90')
+)
+METRIC_MIN_IDLE_IN_SECONDS = int(                           # Time since an instance was last busy for it to be eligible
+    os.getenv('METRIC_MIN_IDLE_IN_SECONDS', '0')
+)
+METRIC_MAX_SLOPE_PER_MINUTE = float(                        # Trend above which an instance is considered to be getting busy
+    os.getenv('METRIC_MAX_SLOPE_PER_MINUTE', 'inf')
+)
+
+METRIC_SCORING = os.getenv(                                 # Strategy whose selection is returned, such as 'threshold'
+    'METRIC_SCORING', 'threshold'                           # for METRIC_NAME or 'weighted' for METRIC_WEIGHTS
+)
+METRIC_SHADOW_STRATEGIES = [                                # Strategies evaluated on the same metrics and only logged
+    strategy.strip() for strategy in os.getenv('METRIC_SHADOW_STRATEGIES', '').split(',') if strategy.strip()
 ]
+STRATEGIES = [METRIC_SCORING] + METRIC_SHADOW_STRATEGIES
+
+
+def parse_metric_values(value):
+    """Parses a comma separated list of metric=value pairs into a dictionary,
+    metrics outside METRIC_NAMESPACE are written as Namespace:MetricName
+
+    Keyword arguments:
+    value -- string such as 'CPUUtilization=1,NetworkIn=0.5'
+    """
+
+    pairs = [pair.rsplit('=', 1) for pair in value.split(',') if pair.strip()]
+
+    return {metric.strip(): float(number) for metric, number in pairs}
+
+
+METRIC_WEIGHTS = parse_metric_values(                       # Weight of each metric in the score of an instance
+    os.getenv('METRIC_WEIGHTS', '{}=1'.format(METRIC_NAME))
+)
+METRIC_THRESHOLDS = parse_metric_values(                    # Values below which an instance is eligible for termination
+    os.getenv('METRIC_THRESHOLDS', '{}={}'.format(METRIC_NAME, METRIC_THRESHOLD))
+)
+
+if ('weighted' in STRATEGIES or METRIC_SAMPLING == 'series') and np is None:
+    raise ImportError('The weighted strategy and METRIC_SAMPLING=series require NumPy, '
+                      'deploy the function with a layer that provides it')
+
+if 'weighted' in STRATEGIES:
+    METRICS = list(dict.fromkeys(
+        ([METRIC_NAME] if STRATEGIES != ['weighted'] else []) + list(METRIC_WEIGHTS) + list(METRIC_THRESHOLDS)
+    ))
+else:
+    METRICS = [
+        METRIC_NAME
+    ]
+    METRIC_THRESHOLDS = {METRIC_NAME: METRIC_THRESHOLD}
+
+METRIC_DATA_MAX_QUERIES = 500                               # Maximum number of queries accepted by a single GetMetricData call
+METRIC_DATA_MAX_WORKERS = int(                              # Maximum number of GetMetricData calls issued concurrently
+    os.getenv('METRIC_DATA_MAX_WORKERS', '8')
+)
+METRIC_LATENCY_SLO_IN_MILLISECONDS = int(                  # Maximum time the function takes to answer Auto Scaling
+    os.getenv('METRIC_LATENCY_SLO_IN_MILLISECONDS', '10000')
+)
+METRIC_DEADLINE_MARGIN_IN_MILLISECONDS = int(              # Time reserved to select instances once the deadline is reached
+    os.getenv('METRIC_DEADLINE_MARGIN_IN_MILLISECONDS', '500')
+)
+METRIC_CACHE_TTL_IN_SECONDS = int(                          # Time during which retrieved metrics are reused by later invocations
+    os.getenv('METRIC_CACHE_TTL_IN_SECONDS', str(METRIC_TIME_WINDOW_IN_MINUTES * 60 // 5))
+)
+METRIC_CACHE_MAX_ENTRIES = int(                             # Maximum number of instances whose metrics are cached
+    os.getenv('METRIC_CACHE_MAX_ENTRIES', '10000')
+)
+METRIC_SNAPSHOT_STORE = os.getenv(                          # Store of the snapshots refreshed by snapshot_handler, such as
+    'METRIC_SNAPSHOT_STORE', ''                             # file:///tmp/snapshots or dynamodb://table-name, empty to disable
+)
+METRIC_SNAPSHOT_MAX_AGE_IN_SECONDS = int(                   # Age after which a snapshot is stale and metrics are retrieved
+    os.getenv('METRIC_SNAPSHOT_MAX_AGE_IN_SECONDS', '120')
+)
+INSTRUMENTATION = os.getenv(                                # Either 'off', 'summary' for one record per invocation
+    'INSTRUMENTATION', 'summary'                            # or 'detailed' for an additional record per availability zone
+)
+INSTRUMENTATION_NAMESPACE = os.getenv(                      # CloudWatch namespace of the embedded metrics
+    'INSTRUMENTATION_NAMESPACE', 'CustomTerminationPolicy'
+)
+INSTANCE_DUMP_SAMPLE_RATE = float(                          # Fraction of invocations that log every received instance
+    os.getenv('INSTANCE_DUMP_SAMPLE_RATE', '0.01')
+)
+
+METRIC_DATA_MAX_ATTEMPTS = 2                                # Attempts of a GetMetricData call, which together fit in the SLO
+METRIC_DATA_TIMEOUT_IN_SECONDS = max(                       # Connect and read timeout of every attempt
+    1, (METRIC_LATENCY_SLO_IN_MILLISECONDS - METRIC_DEADLINE_MARGIN_IN_MILLISECONDS) / 1000 / METRIC_DATA_MAX_ATTEMPTS
+)
+
+# Created once per execution environment and reused by warm invocations,
+# a call that hangs is abandoned after its timeout instead of holding a worker past the SLO
+cloudwatch = boto3.client('cloudwatch', config=Config(
+    connect_timeout=METRIC_DATA_TIMEOUT_IN_SECONDS,
+    read_timeout=METRIC_DATA_TIMEOUT_IN_SECONDS,
+    retries={'mode': 'standard', 'total_max_attempts': METRIC_DATA_MAX_ATTEMPTS}
+))
+
+
+class MetricCache:
+    """Caches the metrics of each instance across invocations,
+    evicting entries older than the TTL or beyond the maximum number of entries
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, instance_id):
+        """Returns the cached metrics of an instance, or None if they are missing or expired
+
+        Keyword arguments:
+        instance_id -- id of the instance
+        """
+
+        with self.lock:
+            self.evict()
+            entry = self.entries.get(instance_id)
+
+        return entry[1] if entry else None
+
+    def put(self, instance_id, metrics):
+        """Caches the metrics of an instance
+
+        Keyword arguments:
+        instance_id -- id of the instance
+        metrics -- dictionary with the value of each metric
+        """
+
+        with self.lock:
+            self.entries.pop(instance_id, None)
+            self.entries[instance_id] = (time.monotonic(), metrics)
+            self.evict()
+
+    def evict(self):
+        """Removes expired entries and the oldest entries beyond the maximum, entries are kept in insertion order
+        """
+
+        expiration = time.monotonic() - self.ttl
+
+        while self.entries and (len(self.entries) > self.max_entries or next(iter(self.entries.values()))[0] < expiration):
+            self.entries.popitem(last=False)
+
+
+metric_cache = MetricCache(METRIC_CACHE_TTL_IN_SECONDS, METRIC_CACHE_MAX_ENTRIES)
+
+
+class EmbeddedMetrics:
+    """Collects the metrics of an invocation and logs them in CloudWatch Embedded Metric Format,
+    so that CloudWatch extracts them from the logs without any API call on the hot path
+    """
+
+    # Maximum number of values of a metric in a single record
+    MAX_VALUES = 100
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.values = {}
+        self.units = {}
+
+    def put(self, name, value, unit='Count'):
+        """Adds a value to a metric of the current invocation
+
+        Keyword arguments:
+        name -- name of the metric
+        value -- value of the metric
+        unit -- CloudWatch unit of the metric
+        """
+
+        with self.lock:
+            values = self.values.setdefault(name, [])
+
+            if len(values) < self.MAX_VALUES:
+                values.append(value)
+                self.units[name] = unit
+
+    def log(self, dimensions, values, units, properties=None):
+        """Logs a record in Embedded Metric Format
+
+        Keyword arguments:
+        dimensions -- dictionary with the name and value of every dimension
+        values -- dictionary with the value, or list of values, of every metric
+        units -- dictionary with the unit of every metric
+        properties -- dictionary with additional properties that are logged but not extracted as metrics
+        """
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in values]
+                }]
+            }
+        }
+        record.update(properties or {})
+        record.update(dimensions)
+        record.update(values)
+
+        print(json.dumps(record, separators=(',', ':')))
+
+    def flush(self, dimensions, properties=None):
+        """Logs the metrics of the invocation
+
+        Keyword arguments:
+        dimensions -- dictionary with the name and value of every dimension
+        properties -- dictionary with additional properties that are logged but not extracted as metrics
+        """
+
+        with self.lock:
+            values, units = self.values, self.units
+            self.values, self.units = {}, {}
+
+        if values and INSTRUMENTATION != 'off':
+            self.log(dimensions, values, units, properties)
+
+
+# Replaced at the start of every invocation, retrievals that outlast the deadline keep writing
+# to the instance of the invocation that submitted them, so their metrics never reach the next one
+embedded_metrics = EmbeddedMetrics(INSTRUMENTATION_NAMESPACE)
+
+
+def encode_snapshot(entries):
+    """Encodes the metrics of every instance in a compressed JSON document
+
+    Keyword arguments:
+    entries -- dictionary with the metrics of every instance
+    """
+
+    return zlib.compress(json.dumps(entries, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_snapshot(data):
+    """Decodes the metrics of every instance from a compressed JSON document
+
+    Keyword arguments:
+    data -- bytes returned by encode_snapshot
+    """
+
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+class FileSnapshotStore:
+    """Stores the snapshot of every Auto Scaling group in a local directory,
+    useful for testing and for running the policy outside Lambda
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_file(self, group_name):
+        """Returns the file that holds the snapshot of a group
+
+        Keyword arguments:
+        group_name -- name of the Auto Scaling group
+        """
+
+        return os.path.join(self.path, '{}.snapshot'.format(quote(group_name, safe='')))
+
+    def load(self, group_name):
+        """Returns the timestamp and the metrics of every instance in the snapshot of a group, or None if there is none
+
+        Keyword arguments:
+        group_name -- name of the Auto Scaling group
+        """
+
+        try:
+            with open(self.get_file(group_name), 'rb') as fd:
+                timestamp = float(fd.readline())
+                return timestamp, decode_snapshot(fd.read())
+        except FileNotFoundError:
+            return None
+
+    def save(self, group_name, timestamp, entries):
+        """Replaces the snapshot of a group
+
+        Keyword arguments:
+        group_name -- name of the Auto Scaling group
+        timestamp -- time.time() value at which the metrics were retrieved
+        entries -- dictionary with the metrics of every instance
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Write to a temporary file and rename it so that readers never see a partial snapshot
+        temporary_file = '{}.tmp'.format(self.get_file(group_name))
+
+        with open(temporary_file, 'wb') as fd:
+            fd.write('{}\n'.format(timestamp).encode('utf-8'))
+            fd.write(encode_snapshot(entries))
+
+        os.replace(temporary_file, self.get_file(group_name))
+
+
+class DynamoDBSnapshotStore:
+    """Stores the snapshot of every Auto Scaling group as a single item of a DynamoDB table
+    whose partition key is AutoScalingGroupName, so that it is read with a single GetItem call
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.client = boto3.client('dynamodb')
+
+    def load(self, group_name):
+        """Returns the timestamp and the metrics of every instance in the snapshot of a group, or None if there is none
+
+        Keyword arguments:
+        group_name -- name of the Auto Scaling group
+        """
+
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={'AutoScalingGroupName': {'S': group_name}}
+        ).get('Item')
+
+        if item is None:
+            return None
+
+        return float(item['Timestamp']['N']), decode_snapshot(item['Snapshot']['B'])
+
+    def save(self, group_name, timestamp, entries):
+        """Replaces the snapshot of a group
+
+        Keyword arguments:
+        group_name -- name of the Auto Scaling group
+        timestamp -- time.time() value at which the metrics were retrieved
+        entries -- dictionary with the metrics of every instance
+        """
+
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                'AutoScalingGroupName': {'S': group_name},
+                'Timestamp': {'N': str(timestamp)},
+                'Snapshot': {'B': encode_snapshot(entries)}
+            }
+        )
+
+
+def get_snapshot_store(url):
+    """Returns the snapshot store for a file:// or dynamodb:// URL, or None if the URL is empty
+
+    Keyword arguments:
+    url -- location of the snapshots
+    """
+
+    if not url:
+        return None
+
+    scheme, _, location = url.partition('://')
+
+    if scheme == 'file':
+        return FileSnapshotStore(location)
+    elif scheme == 'dynamodb':
+        return DynamoDBSnapshotStore(location)
+
+    raise ValueError('Unsupported snapshot store: {}'.format(url))
+
+
+snapshot_store = get_snapshot_store(METRIC_SNAPSHOT_STORE)
+
+
+def load_snapshot(group_name):
+    """Returns the metrics of every instance in the snapshot of a group,
+    or an empty dictionary if snapshots are disabled, missing, stale or cannot be read,
+    in which case the metrics are retrieved with GetMetricData
+
+    Keyword arguments:
+    group_name -- name of the Auto Scaling group
+    """
+
+    if snapshot_store is None or not group_name:
+        return {}
+
+    try:
+        snapshot = snapshot_store.load(group_name)
+    except (ClientError, BotoCoreError, OSError, ValueError, zlib.error) as error:
+        print('Error loading the snapshot of {}, retrieving its metrics instead: {}'.format(group_name, error))
+        embedded_metrics.put('SnapshotErrors', 1)
+        return {}
+
+    if snapshot is None:
+        return {}
+
+    timestamp, entries = snapshot
+
+    if time.time() - timestamp > METRIC_SNAPSHOT_MAX_AGE_IN_SECONDS:
+        print('Snapshot of {} is stale, it was taken {:.0f} seconds ago'.format(group_name, time.time() - timestamp))
+        return {}
+
+    return entries
+
+
+def get_metric_namespace(metric):
+    """Returns the namespace and metric name of a metric written as [Namespace:]MetricName
+
+    Keyword arguments:
+    metric -- metric name, optionally prefixed by its namespace
+    """
+
+    namespace, _, metric_name = metric.rpartition(':')
+
+    return namespace or METRIC_NAMESPACE, metric_name
 
 
 def generate_time_window():
@@ -23,74 +458,372 @@ def generate_time_window():
     end_time = datetime.datetime.now()
     start_time = end_time - datetime.timedelta(minutes=METRIC_TIME_WINDOW_IN_MINUTES)
 
-    # Calculate the number of seconds in the time widow and use it as period to retrieve only one sample
-    period = int((end_time - start_time).total_seconds())
+    if METRIC_SAMPLING == 'series':
+        # Retrieve one sample per period to analyze how the metrics evolve during the time window
+        period = METRIC_PERIOD_IN_SECONDS
+    else:
+        # Calculate the number of seconds in the time widow and use it as period to retrieve only one sample
+        period = int((end_time - start_time).total_seconds())
 
     return start_time, end_time, period
 
 
-def get_metric_data(instances, start_time, end_time, period):
-    """Retrieves CloudWatch metric data
+def fetch_metric_data(client, metric_data_queries, start_time, end_time, metrics):
+    """Retrieves CloudWatch metric data for up to METRIC_DATA_MAX_QUERIES queries
+    and returns the results of every page
 
     Keyword arguments:
-    instances -- list with instance information
+    client -- CloudWatch client
+    metric_data_queries -- list of metric data queries
     start_time -- time stamp that determines the first data point to return
     end_time -- time stamp that determines the last data point to return
-    period -- the granularity of the returned data points
+    metrics -- EmbeddedMetrics of the invocation that submitted the retrieval
     """
 
-    client = boto3.client('cloudwatch')
+    start = time.perf_counter()
     paginator = client.get_paginator('get_metric_data')
 
-    # Hold the metrics for each instance in the form of:
-    # + instanceId1
-    #   + metricName1: 0
-    #   + metricName2: 0
-    # ...
-    metric_data = {instance['InstanceId']: {metric_name: 0 for metric_name in METRICS} for instance in instances}
+    response = paginator.paginate(
+        MetricDataQueries=metric_data_queries,
+        StartTime=start_time,
+        EndTime=end_time
+    )
+
+    pages = list(response)
+
+    metrics.put('GetMetricDataLatency', (time.perf_counter() - start) * 1000, 'Milliseconds')
+    metrics.put('GetMetricDataPages', len(pages))
+    metrics.put('GetMetricDataQueries', len(metric_data_queries))
+
+    return [result for page in pages for result in page['MetricDataResults']]
+
+
+def add_metric_series(series, metric, result):
+    """Adds the data points of a metric data result to the series of a metric,
+    the data points of a result can be split across pages
+
+    Keyword arguments:
+    series -- dictionary with the timestamps and values of every metric
+    metric -- (instance id, metric name) tuple the result belongs to
+    result -- metric data result
+    """
+
+    if result['Values']:
+        timestamps, values = series.setdefault(metric, ([], []))
+        timestamps.extend(result['Timestamps'])
+        values.extend(result['Values'])
+
+
+def wait_for_metric_data(futures, deadline):
+    """Waits until every retrieval completes or the deadline is reached and returns the completed ones
+
+    Keyword arguments:
+    futures -- list of futures of fetch_metric_data calls
+    deadline -- time.monotonic() value by which results are needed, or None to wait for every retrieval
+    """
+
+    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+    done, _ = wait(futures, timeout=timeout)
+
+    return done
+
+
+def get_instance_metric_data(executor, metrics, start_time, end_time, period, deadline):
+    """Retrieves CloudWatch metric data using one MetricStat query per instance and metric
+    and returns the timestamps and values of every metric that has data points,
+    and the metrics whose retrieval did not complete before the deadline
+
+    Queries are split in chunks of METRIC_DATA_MAX_QUERIES that are retrieved concurrently,
+    and results are mapped back to their instance and metric through the query Id
+
+    Keyword arguments:
+    executor -- ThreadPoolExecutor of the invocation
+    metrics -- list of (instance id, metric name) tuples to retrieve
+    start_time -- time stamp that determines the first data point to return
+    end_time -- time stamp that determines the last data point to return
+    period -- the granularity of the returned data points
+    deadline -- time.monotonic() value by which results are needed, or None to wait for every retrieval
+    """
+
+    series = {}
+
+    # Map every query Id to the instance and metric it retrieves
+    queries = {'q{}'.format(index): metric for index, metric in enumerate(metrics)}
 
     # List that contains one entry per instance and metric used to retrieve CloudWatch metric data
-    metric_data_queries = [
-        {
-            'Id': '{}{}'.format(instance['InstanceId'].replace('-', '_'), metric_name),
+    metric_data_queries = []
+
+    for query_id, (instance_id, metric) in queries.items():
+        namespace, metric_name = get_metric_namespace(metric)
+
+        metric_data_queries.append({
+            'Id': query_id,
             'MetricStat': {
                 'Metric': {
-                    'Namespace': 'AWS/EC2',
+                    'Namespace': namespace,
                     'MetricName': metric_name,
                     'Dimensions': [
                         {
                             'Name': 'InstanceId',
-                            'Value': instance['InstanceId']
+                            'Value': instance_id
                         }
                     ]
                 },
                 'Stat': METRIC_STAT,
                 'Period': period
             },
-            'ReturnData': True,
-            'Label': '{}_{}'.format(instance['InstanceId'], metric_name)
-        } for instance in instances for metric_name in METRICS
+            'ReturnData': True
+        })
+
+    chunks = [
+        metric_data_queries[index:index + METRIC_DATA_MAX_QUERIES]
+        for index in range(0, len(metric_data_queries), METRIC_DATA_MAX_QUERIES)
     ]
 
-    response = paginator.paginate(
-        MetricDataQueries=metric_data_queries,
-        StartTime=start_time,
-        EndTime=end_time
+    # Retrieve every chunk concurrently, boto3 clients are thread safe
+    futures = [executor.submit(fetch_metric_data, cloudwatch, chunk, start_time, end_time, embedded_metrics) for chunk in chunks]
+    done = wait_for_metric_data(futures, deadline)
+    pending = set()
+
+    for future, chunk in zip(futures, chunks):
+        if future in done:
+            for result in future.result():
+                add_metric_series(series, queries[result['Id']], result)
+        else:
+            pending.update(queries[query['Id']] for query in chunk)
+
+    return series, pending
+
+
+def get_search_metric_data(executor, metrics, start_time, end_time, period, deadline):
+    """Retrieves CloudWatch metric data using one SEARCH expression per metric,
+    which returns the metric of every instance in the namespace, and returns the timestamps and values
+    of the requested instances that are found in the results, and the metrics whose retrieval
+    did not complete before the deadline
+
+    Every time series is labeled with its InstanceId dimension, so results are filtered locally
+
+    Keyword arguments:
+    executor -- ThreadPoolExecutor of the invocation
+    metrics -- list of (instance id, metric name) tuples to retrieve
+    start_time -- time stamp that determines the first data point to return
+    end_time -- time stamp that determines the last data point to return
+    period -- the granularity of the returned data points
+    deadline -- time.monotonic() value by which results are needed, or None to wait for the retrieval
+    """
+
+    series = {}
+
+    # Map every query Id to the metric it searches
+    queries = {
+        'q{}'.format(index): metric_name
+        for index, metric_name in enumerate(sorted({metric_name for _, metric_name in metrics}))
+    }
+
+    metric_data_queries = [
+        {
+            'Id': query_id,
+            'Expression': "SEARCH('{{{},InstanceId}} MetricName=\"{}\"', '{}', {})".format(
+                *get_metric_namespace(metric_name), METRIC_STAT, period
+            ),
+            'Label': "${PROP('Dim.InstanceId')}",
+            'ReturnData': True
+        } for query_id, metric_name in queries.items()
+    ]
+
+    requested = set(metrics)
+    future = executor.submit(fetch_metric_data, cloudwatch, metric_data_queries, start_time, end_time, embedded_metrics)
+
+    if future not in wait_for_metric_data([future], deadline):
+        return series, requested
+
+    for result in future.result():
+        metric = (result['Label'], queries[result['Id']])
+
+        if metric in requested:
+            add_metric_series(series, metric, result)
+
+    return series, set()
+
+
+def summarize_metric_series(series, end_time, period):
+    """Summarizes the data points of every metric in a single vectorized pass
+    and returns, for each metric, its percentile, its trend and the time since it was last busy
+
+    Data points are placed in a matrix of metrics x periods, where the first column holds the newest period.
+    The trend is the least squares slope per minute, and a metric is busy when it is above its value in METRIC_THRESHOLDS
+
+    Keyword arguments:
+    series -- dictionary with the timestamps and values of every (instance id, metric name) tuple
+    end_time -- time stamp of the last data point that was requested
+    period -- the granularity of the data points
+    """
+
+    metrics = list(series)
+    columns = max(1, METRIC_TIME_WINDOW_IN_MINUTES * 60 // period)
+
+    # Place every data point in the column of its period, counting back from the end of the time window
+    rows = np.repeat(np.arange(len(metrics)), [len(series[metric][1]) for metric in metrics])
+    ages = end_time.timestamp() - np.array(
+        [timestamp.timestamp() for metric in metrics for timestamp in series[metric][0]], dtype=float
     )
+    values = np.array([value for metric in metrics for value in series[metric][1]], dtype=float)
+
+    matrix = np.full((len(metrics), columns), np.nan)
+    matrix[rows, np.clip((ages // period).astype(int), 0, columns - 1)] = values
+
+    available = ~np.isnan(matrix)
+    counts = available.sum(axis=1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        percentiles = np.nanpercentile(matrix, METRIC_PERCENTILE, axis=1)
+
+    # Minutes relative to the end of the time window, the newest period being 0
+    minutes = -np.arange(columns) * period / 60
+    mean_minutes = np.divide((available * minutes).sum(axis=1), counts, out=np.zeros(len(metrics)), where=counts > 0)
+    mean_values = np.divide(np.nansum(matrix, axis=1), counts, out=np.zeros(len(metrics)), where=counts > 0)
+    delta_minutes = np.where(available, minutes - mean_minutes[:, None], 0)
+    delta_values = np.where(available, matrix - mean_values[:, None], 0)
+    variances = (delta_minutes ** 2).sum(axis=1)
+    slopes = np.divide(
+        (delta_minutes * delta_values).sum(axis=1), variances, out=np.zeros(len(metrics)), where=variances > 0
+    )
+
+    # The newest busy period determines the time since the metric was last busy
+    thresholds = np.array([METRIC_THRESHOLDS.get(metric_name, np.inf) for _, metric_name in metrics])
+    busy = np.nan_to_num(matrix, nan=-np.inf) > thresholds[:, None]
+    idle_seconds = np.where(busy.any(axis=1), busy.argmax(axis=1), columns) * period
+
+    return {
+        metric: (float(percentile), float(slope), int(idle))
+        for metric, percentile, slope, idle in zip(metrics, percentiles, slopes, idle_seconds)
+    }
+
+
+def get_metric_data(instances, start_time, end_time, period, deadline=None, snapshot=None):
+    """Retrieves CloudWatch metric data and returns the number of instances whose metrics
+    could not be retrieved before the deadline, which are flagged as Pending and are not cached
+
+    Metrics cached by previous invocations or found in the snapshot are reused, and only the missing instances are retrieved
+    using the fetch mode set in METRIC_FETCH_MODE. With the series sampling, the value of every metric is its
+    METRIC_PERCENTILE, and instances also get the trend of every metric and the time since they were last busy
+
+    Keyword arguments:
+    instances -- list with instance information
+    start_time -- time stamp that determines the first data point to return
+    end_time -- time stamp that determines the last data point to return
+    period -- the granularity of the returned data points
+    deadline -- time.monotonic() value by which results are needed, or None to wait for every retrieval
+    snapshot -- dictionary with the metrics of every instance returned by load_snapshot
+    """
 
-    # Process the retrieved metrics and add them to the metric_data dictionary
-    for page in response:
-        for result in page['MetricDataResults']:
-            instance_id = result['Label'].split('_')[0]
-            metric_name = result['Label'].split('_')[1]
+    snapshot = snapshot or {}
 
-            if result['Values']:
-                metric_data[instance_id][metric_name] = result['Values'][0]
+    # Hold the metrics for each instance in the form of:
+    # + instanceId1
+    #   + Metrics
+    #     + metricName1: 0
+    #     + metricName2: 0
+    #   + Trends (series sampling only)
+    #     + metricName1: 0
+    #   + IdleSeconds: 0 (series sampling only)
+    #   + NoData: [metricName2] (metrics without data points in the time window)
+    # ...
+    metric_data = {}
+    missing_instance_ids = []
+    cached_instances = 0
+
+    for instance in instances:
+        cached_metrics = metric_cache.get(instance['InstanceId'])
+        snapshot_metrics = snapshot.get(instance['InstanceId'])
+
+        if cached_metrics is not None:
+            metric_data[instance['InstanceId']] = cached_metrics
+            cached_instances += 1
+        elif snapshot_metrics is not None and set(METRICS) <= set(snapshot_metrics['Metrics']):
+            metric_data[instance['InstanceId']] = snapshot_metrics
+        else:
+            metric_data[instance['InstanceId']] = {'Metrics': {metric_name: 0 for metric_name in METRICS}}
+            missing_instance_ids.append(instance['InstanceId'])
+
+            if METRIC_SAMPLING == 'series':
+                metric_data[instance['InstanceId']].update({
+                    'Trends': {metric_name: 0 for metric_name in METRICS},
+                    'IdleSeconds': METRIC_TIME_WINDOW_IN_MINUTES * 60
+                })
+
+    embedded_metrics.put('CachedInstances', cached_instances)
+    embedded_metrics.put('SnapshotInstances', len(instances) - cached_instances - len(missing_instance_ids))
+
+    missing_metrics = [
+        (instance_id, metric_name) for instance_id in missing_instance_ids for metric_name in METRICS
+    ]
+    series = {}
+    pending = set()
+
+    # Every invocation has its own workers, retrievals abandoned at the deadline keep running without
+    # delaying later invocations, and the chunks that were not started yet are never sent
+    executor = ThreadPoolExecutor(max_workers=METRIC_DATA_MAX_WORKERS)
+
+    try:
+        if METRIC_FETCH_MODE == 'search' and missing_metrics:
+            series, pending = get_search_metric_data(executor, missing_metrics, start_time, end_time, period, deadline)
+
+            # A SEARCH expression returns a limited number of time series, so metrics not found are queried per instance
+            missing_metrics = [metric for metric in missing_metrics if metric not in series and metric not in pending]
+
+        instance_series, instance_pending = get_instance_metric_data(
+            executor, missing_metrics, start_time, end_time, period, deadline
+        )
+        series.update(instance_series)
+        pending.update(instance_pending)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # Add the retrieved metrics to the metric_data dictionary
+    if METRIC_SAMPLING == 'series' and series:
+        for (instance_id, metric_name), (percentile, slope, idle_seconds) in summarize_metric_series(
+                series, end_time, period).items():
+            metric_data[instance_id]['Metrics'][metric_name] = percentile
+            metric_data[instance_id]['Trends'][metric_name] = slope
+            metric_data[instance_id]['IdleSeconds'] = min(metric_data[instance_id]['IdleSeconds'], idle_seconds)
+    else:
+        # Data points are returned newest first
+        for (instance_id, metric_name), (_, values) in series.items():
+            metric_data[instance_id]['Metrics'][metric_name] = values[0]
+
+    pending_instance_ids = {instance_id for instance_id, _ in pending}
+
+    for instance_id in missing_instance_ids:
+        metric_data[instance_id]['NoData'] = [
+            metric_name for metric_name in METRICS if (instance_id, metric_name) not in series
+        ]
+
+        if instance_id not in pending_instance_ids:
+            metric_cache.put(instance_id, metric_data[instance_id])
+
+    # Update the list of instances to include the retrieved metrics
+    for instance in instances:
+        instance.update(metric_data[instance['InstanceId']])
+        instance['Pending'] = instance['InstanceId'] in pending_instance_ids
+
+    return len(pending_instance_ids)
+
+
+def is_idle_instance(instance):
+    """Returns whether an instance has been idle for METRIC_MIN_IDLE_IN_SECONDS and none of its metrics
+    is trending up faster than METRIC_MAX_SLOPE_PER_MINUTE, which is always the case with the window sampling
+
+    Keyword arguments:
+    instance -- dictionary with instance data
+    """
 
-            # Update the list of instances to include the retrieved metrics
-            for instance in instances:
-                if instance['InstanceId'] == instance_id:
-                    instance.update({'Metrics': metric_data[instance_id]})
+    if METRIC_SAMPLING != 'series':
+        return True
+
+    return (instance['IdleSeconds'] >= METRIC_MIN_IDLE_IN_SECONDS and
+            all(slope <= METRIC_MAX_SLOPE_PER_MINUTE for slope in instance['Trends'].values()))
 
 
 def should_terminate_instance(instance, capacities):
@@ -102,45 +835,419 @@ def should_terminate_instance(instance, capacities):
     capacities -- dictionary with the suggested number of instances to terminate per availability zone
     """
 
-    return instance['Metrics'][METRIC_NAME] < METRIC_THRESHOLD and capacities[instance['AvailabilityZone']] > 0
+    return (instance['Metrics'][METRIC_NAME] < METRIC_THRESHOLD and is_idle_instance(instance) and
+            not instance['Pending'] and capacities[instance['AvailabilityZone']] > 0)
+
+
+def has_complete_data(instance):
+    """Returns whether every metric of an instance was retrieved with data points,
+    the metrics of other instances hold placeholder values that must not rank them as idle
+
+    Keyword arguments:
+    instance -- dictionary with instance data
+    """
+
+    return not instance['Pending'] and not instance.get('NoData')
 
 
 def instances_sorting_func(instance):
     """Implements the instances sorting logic using CloudWatch metric data
 
+    Instances without complete data are sorted after the others, as in every strategy,
+    and instances with the same metric value are sorted by the time since they were last busy, longest first
+
     Keyword arguments:
     instance -- dictionary with instance data
     """
 
-    return instance['Metrics'][METRIC_NAME]
+    return not has_complete_data(instance), instance['Metrics'][METRIC_NAME], -instance.get('IdleSeconds', 0)
+
+
+def select_instances_by_threshold(instances, capacities):
+    """Returns the instances whose METRIC_NAME is below METRIC_THRESHOLD, lowest values first,
+    up to the suggested number of instances to terminate in each availability zone
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    """
+
+    capacities = dict(capacities)
+    instances_to_terminate = []
+
+    # Sort the instances in ascending order by their metric values (idle instances first)
+    # and select instances for termination using capacity information and the retrieved CloudWatch metric data
+    for instance in sorted(instances, key=instances_sorting_func):
+        if should_terminate_instance(instance, capacities):
+            instances_to_terminate.append(instance['InstanceId'])
+            capacities[instance['AvailabilityZone']] -= 1
+
+    return instances_to_terminate
+
+
+def select_instances_by_idle_time(instances, capacities):
+    """Returns the instances whose METRIC_NAME is below METRIC_THRESHOLD, longest idle first,
+    up to the suggested number of instances to terminate in each availability zone.
+    Requires the series sampling, otherwise instances are ordered as in select_instances_by_threshold
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    """
+
+    capacities = dict(capacities)
+    instances_to_terminate = []
+
+    for instance in sorted(instances, key=lambda instance: (
+            not has_complete_data(instance), -instance.get('IdleSeconds', 0), instance['Metrics'][METRIC_NAME])):
+        if should_terminate_instance(instance, capacities):
+            instances_to_terminate.append(instance['InstanceId'])
+            capacities[instance['AvailabilityZone']] -= 1
+
+    return instances_to_terminate
+
+
+def select_lowest_instances(instances, capacities):
+    """Returns the instances with the lowest METRIC_NAME regardless of METRIC_THRESHOLD,
+    so that the suggested number of instances to terminate is always reached in each availability zone
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    """
+
+    capacities = dict(capacities)
+    instances_to_terminate = []
+
+    for instance in sorted(instances, key=lambda instance: (instance['Pending'], instances_sorting_func(instance))):
+        if capacities.get(instance['AvailabilityZone'], 0) > 0:
+            instances_to_terminate.append(instance['InstanceId'])
+            capacities[instance['AvailabilityZone']] -= 1
+
+    return instances_to_terminate
+
+
+def score_instances(instances):
+    """Scores every instance in a single vectorized pass and returns the scores,
+    where lower values mean more idle instances, whether each instance is eligible for termination,
+    and whether each instance has data for every metric
+
+    Every metric is normalized to the [0, 1] range across the instances that have data for it and multiplied by
+    its weight in METRIC_WEIGHTS, and an instance is eligible when all its metrics are below their value in
+    METRIC_THRESHOLDS. With the series sampling, an instance must also be idle as defined by is_idle_instance.
+    Instances without data, still pending or without data points, do not move the bounds of the normalization
+    and are ranked after the instances that have data, as in every strategy
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    """
+
+    # Matrix of instances x metrics
+    values = np.array(
+        [[instance['Metrics'][metric] for metric in METRICS] for instance in instances], dtype=float
+    ).reshape(len(instances), len(METRICS))
+
+    # Placeholder values of instances without data are left out of the bounds
+    pending = np.array([instance['Pending'] for instance in instances], dtype=bool)
+    has_data = ~pending[:, None] & np.array(
+        [[metric not in instance.get('NoData', []) for metric in METRICS] for instance in instances], dtype=bool
+    ).reshape(len(instances), len(METRICS))
+
+    minimum = np.where(has_data, values, np.inf).min(axis=0, initial=np.inf)
+    span = np.where(has_data, values, -np.inf).max(axis=0, initial=-np.inf) - minimum
+    normalized = np.divide(values - minimum, span, out=np.zeros_like(values), where=has_data & (span > 0))
+
+    weights = np.array([METRIC_WEIGHTS.get(metric, 0) for metric in METRICS])
+    thresholds = np.array([METRIC_THRESHOLDS.get(metric, np.inf) for metric in METRICS])
+
+    eligible = (values < thresholds).all(axis=1)
+
+    if METRIC_SAMPLING == 'series':
+        idle_seconds = np.array([instance['IdleSeconds'] for instance in instances], dtype=float)
+        trends = np.array(
+            [[instance['Trends'][metric] for metric in METRICS] for instance in instances], dtype=float
+        ).reshape(len(instances), len(METRICS))
+
+        eligible &= (idle_seconds >= METRIC_MIN_IDLE_IN_SECONDS) & (trends <= METRIC_MAX_SLOPE_PER_MINUTE).all(axis=1)
+
+    eligible &= ~pending
+
+    return normalized @ weights, eligible, has_data.all(axis=1)
+
+
+def select_instances_by_score(instances, capacities):
+    """Returns the eligible instances with the lowest score in each availability zone,
+    up to the suggested number of instances to terminate in that zone
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    """
+
+    scores, eligible, complete = score_instances(instances)
+
+    zones, zone_index = np.unique(
+        np.array([instance['AvailabilityZone'] for instance in instances], dtype=str), return_inverse=True
+    )
+    zone_capacity = np.array([capacities.get(zone, 0) for zone in zones], dtype=int)
+
+    # Group eligible instances by availability zone with the lowest scores first, instances without data last
+    candidates = np.flatnonzero(eligible)
+    order = candidates[np.lexsort((scores[candidates], ~complete[candidates], zone_index[candidates]))]
+    order_zones = zone_index[order]
+
+    # Position of every instance within its availability zone
+    rank = np.arange(len(order)) - np.searchsorted(order_zones, order_zones, side='left')
+
+    selected = order[rank < zone_capacity[order_zones]]
+
+    # Return the selected instances with the lowest scores first, keeping the received order on ties
+    selected = selected[np.lexsort((selected, scores[selected], ~complete[selected]))]
+
+    return [instances[index]['InstanceId'] for index in selected]
+
+
+# Strategies that can be set in METRIC_SCORING and METRIC_SHADOW_STRATEGIES,
+# every strategy receives the instances with their metrics and returns the ids of the instances to terminate
+SELECTION_STRATEGIES = {
+    'threshold': select_instances_by_threshold,
+    'weighted': select_instances_by_score,
+    'idle_time': select_instances_by_idle_time,
+    'lowest': select_lowest_instances
+}
+
+for strategy in STRATEGIES:
+    if strategy not in SELECTION_STRATEGIES:
+        raise ValueError('Unknown selection strategy: {}'.format(strategy))
+
+
+def evaluate_shadow_strategies(event, instances, capacities, instances_to_terminate, duration):
+    """Evaluates every strategy in METRIC_SHADOW_STRATEGIES against the metrics retrieved for the primary strategy,
+    and logs a structured record with the selection and duration of each strategy for offline comparison
+
+    Keyword arguments:
+    event -- event received from Auto Scaling
+    instances -- list with instance information, including its metrics
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    instances_to_terminate -- list with the ids of the instances selected by the primary strategy
+    duration -- time in milliseconds taken by the primary strategy
+    """
+
+    primary = set(instances_to_terminate)
+    shadows = []
+
+    for strategy in METRIC_SHADOW_STRATEGIES:
+        start = time.perf_counter()
+
+        # A failing shadow strategy must never affect the response
+        try:
+            selected = SELECTION_STRATEGIES[strategy](instances, capacities)
+        except Exception as error:
+            shadows.append({'Strategy': strategy, 'Error': repr(error)})
+            continue
+
+        shadows.append({
+            'Strategy': strategy,
+            'InstanceIDs': selected,
+            'DurationMs': round((time.perf_counter() - start) * 1000, 3),
+            'Overlap': len(primary.intersection(selected))
+        })
+
+    print(json.dumps({
+        'Type': 'ShadowEvaluation',
+        'AutoScalingGroupARN': event.get('AutoScalingGroupARN'),
+        'Cause': event.get('Cause'),
+        'Candidates': len(instances),
+        'CapacityToTerminate': capacities,
+        'Primary': {
+            'Strategy': METRIC_SCORING,
+            'InstanceIDs': instances_to_terminate,
+            'DurationMs': round(duration, 3)
+        },
+        'Shadows': shadows
+    }))
+
+
+def fill_capacity(instances, instances_to_terminate, capacities):
+    """Selects the next-best ranked instances, even if they are not idle, until the suggested number of instances
+    to terminate is reached in every availability zone. Instances whose metrics could not be retrieved are selected last
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    instances_to_terminate -- list with the ids of the instances already selected, which is extended
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    """
+
+    selected = set(instances_to_terminate)
+    remaining = dict(capacities)
+
+    for instance in instances:
+        if instance['InstanceId'] in selected:
+            remaining[instance['AvailabilityZone']] -= 1
+
+    if METRIC_SCORING == 'weighted':
+        scores, _, complete = score_instances(instances)
+        ranking = {
+            instance['InstanceId']: (not has_data, score)
+            for instance, score, has_data in zip(instances, scores.tolist(), complete.tolist())
+        }
+    else:
+        ranking = {instance['InstanceId']: instances_sorting_func(instance) for instance in instances}
+
+    for instance in sorted(instances, key=lambda instance: (instance['Pending'], ranking[instance['InstanceId']])):
+        if instance['InstanceId'] not in selected and remaining.get(instance['AvailabilityZone'], 0) > 0:
+            instances_to_terminate.append(instance['InstanceId'])
+            remaining[instance['AvailabilityZone']] -= 1
+
+
+def get_deadline(context):
+    """Returns the time.monotonic() value by which metric data is needed to answer within
+    METRIC_LATENCY_SLO_IN_MILLISECONDS and before the function times out
+
+    Keyword arguments:
+    context -- Lambda context object, or None when invoked locally
+    """
+
+    budget = METRIC_LATENCY_SLO_IN_MILLISECONDS
+
+    if context is not None:
+        budget = min(budget, context.get_remaining_time_in_millis())
+
+    return time.monotonic() + max(0, budget - METRIC_DEADLINE_MARGIN_IN_MILLISECONDS) / 1000
+
+
+def get_snapshot_entries(instances):
+    """Returns the metrics of every instance in the form stored in snapshots
+
+    Keyword arguments:
+    instances -- list with instance information, including its metrics
+    """
+
+    return {
+        instance['InstanceId']: {key: instance[key] for key in ('Metrics', 'Trends', 'IdleSeconds', 'NoData') if key in instance}
+        for instance in instances if not instance['Pending']
+    }
+
+
+def snapshot_handler(event, context):
+    """Refreshes the snapshot of the Auto Scaling group in AUTO_SCALING_GROUP_NAME,
+    invoked on a schedule so that lambda_handler does not retrieve metrics on the critical path of scale-in
+    """
+
+    global embedded_metrics
+    embedded_metrics = EmbeddedMetrics(INSTRUMENTATION_NAMESPACE)
+
+    group_name = os.getenv('AUTO_SCALING_GROUP_NAME')
+    autoscaling = boto3.client('autoscaling')
+
+    groups = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[group_name])['AutoScalingGroups']
+    instances = [
+        {'InstanceId': instance['InstanceId'], 'AvailabilityZone': instance['AvailabilityZone']}
+        for group in groups for instance in group['Instances']
+    ]
+
+    timestamp = time.time()
+    start_time, end_time, period = generate_time_window()
+    get_metric_data(instances, start_time, end_time, period)
+
+    snapshot_store.save(group_name, timestamp, get_snapshot_entries(instances))
+
+    print('Saved the snapshot of {} instances of {}'.format(len(instances), group_name))
+
+    embedded_metrics.put('SnapshotInstances', len(instances))
+    embedded_metrics.put('SnapshotLatency', (time.time() - timestamp) * 1000, 'Milliseconds')
+    embedded_metrics.flush({'AutoScalingGroupName': group_name, 'Handler': 'snapshot'})
+
+
+def log_selection(group_name, instances, capacities, instances_to_terminate):
+    """Logs the candidates, selected instances and shortfall against the suggested capacity to terminate
+    of every availability zone as embedded metrics
+
+    Keyword arguments:
+    group_name -- name of the Auto Scaling group
+    instances -- list with instance information
+    capacities -- dictionary with the suggested number of instances to terminate per availability zone
+    instances_to_terminate -- list with the ids of the selected instances
+    """
+
+    selected = set(instances_to_terminate)
+    candidates = {zone: 0 for zone in capacities}
+    selections = {zone: 0 for zone in capacities}
+
+    for instance in instances:
+        zone = instance['AvailabilityZone']
+        candidates[zone] = candidates.get(zone, 0) + 1
+
+        if instance['InstanceId'] in selected:
+            selections[zone] = selections.get(zone, 0) + 1
+
+    for zone in candidates:
+        embedded_metrics.log(
+            {'AutoScalingGroupName': group_name, 'AvailabilityZone': zone},
+            {
+                'Candidates': candidates[zone],
+                'Selected': selections.get(zone, 0),
+                'Shortfall': max(0, capacities.get(zone, 0) - selections.get(zone, 0))
+            },
+            {}
+        )
 
 
 def lambda_handler(event, context):
+    global embedded_metrics
+    embedded_metrics = EmbeddedMetrics(INSTRUMENTATION_NAMESPACE)
+
+    # Track the time left to answer Auto Scaling, so that scale-in is never stalled by slow metric retrievals
+    deadline = get_deadline(context)
+    invocation_start = time.perf_counter()
+
     # Generate a time window for retrieving CloudWatch metric data
     start_time, end_time, period = generate_time_window()
 
-    print('Received instances: ', event['Instances'])
+    # Logging every instance is expensive with large groups, so it is only done for a sample of invocations
+    if random.random() < INSTANCE_DUMP_SAMPLE_RATE:
+        print('Received instances: ', event['Instances'])
 
     # Build a dictionary with the form {AvailabilityZone: capacity}
     capacities = {capacity['AvailabilityZone']: capacity['Capacity'] for capacity in event['CapacityToTerminate']}
     instances = event['Instances']
-    instances_to_terminate = []
+
+    # Read the precomputed snapshot of the group, metrics are only retrieved for the instances that are missing
+    group_name = event.get('AutoScalingGroupARN', '').partition('autoScalingGroupName/')[2] or 'unknown'
+    snapshot = load_snapshot(group_name)
 
     # Get CloudWatch metric data for every instance in the generated time window
     # This method will add a `Metrics` property to every dictionary in the instances variable
-    get_metric_data(instances, start_time, end_time, period)
+    pending = get_metric_data(instances, start_time, end_time, period, deadline, snapshot)
 
-    # Sort the instances in ascending order by their metric values (idle instances first)
-    instances.sort(key=instances_sorting_func)
+    # Select instances for termination with the strategy in METRIC_SCORING
+    start = time.perf_counter()
+    instances_to_terminate = SELECTION_STRATEGIES[METRIC_SCORING](instances, capacities)
+    duration = (time.perf_counter() - start) * 1000
 
-    # Select instances for termination using capacity information and the retrieved CloudWatch metric data
-    for instance in instances:
-        if should_terminate_instance(instance, capacities):
-            instances_to_terminate.append(instance['InstanceId'])
-            capacities[instance['AvailabilityZone']] -= 1
+    if pending:
+        # Best effort: complete the suggested capacity with the metrics that are available
+        print('Metrics of {} instances were not retrieved before the deadline'.format(pending))
+
+        fill_capacity(instances, instances_to_terminate, capacities)
+
+    # Evaluate the alternative strategies on the same metrics, only the primary selection is returned
+    if METRIC_SHADOW_STRATEGIES:
+        evaluate_shadow_strategies(event, instances, capacities, instances_to_terminate, duration)
 
     print('Selected instances: {}'.format(', '.join(instances_to_terminate)))
 
+    embedded_metrics.put('Candidates', len(instances))
+    embedded_metrics.put('Selected', len(instances_to_terminate))
+    embedded_metrics.put('Shortfall', max(0, sum(capacities.values()) - len(instances_to_terminate)))
+    embedded_metrics.put('PendingInstances', pending)
+    embedded_metrics.put('SelectionLatency', duration, 'Milliseconds')
+    embedded_metrics.put('InvocationLatency', (time.perf_counter() - invocation_start) * 1000, 'Milliseconds')
+    embedded_metrics.flush({'AutoScalingGroupName': group_name}, {'Strategy': METRIC_SCORING, 'Cause': event.get('Cause')})
+
+    if INSTRUMENTATION == 'detailed':
+        log_selection(group_name, instances, capacities, instances_to_terminate)
+
     return {
         'InstanceIDs': instances_to_terminate
     }
@@ -7,7 +7,11 @@ from aws_cdk import (
     aws_lambda as _lambda,
     aws_iam as iam,
     aws_autoscaling as asg,
-    Fn
+    aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as targets,
+    Fn,
+    RemovalPolicy
 )
 from constructs import Construct
 
@@ -76,6 +80,27 @@ class MetricBasedTerminationStack(Stack):
                                                                  ])
                            ])
 
+    def _get_policy_environment(self):
+        # Environment variables that configure how metrics are retrieved and instances are selected
+        return {'METRIC_NAME': 'CPUUtilization',
+                'METRIC_THRESHOLD': '3',
+                'METRIC_STAT': 'Minimum',
+                'METRIC_TIME_WINDOW_IN_MINUTES': '5',
+                'METRIC_FETCH_MODE': 'instance',
+                'METRIC_SAMPLING': 'window',
+                'METRIC_SCORING': 'threshold',
+                'METRIC_LATENCY_SLO_IN_MILLISECONDS': '10000'}
+
+    def _get_layers(self):
+        # Use the layer that provides NumPy for the weighted scoring and the series sampling, if one is specified in the CDK context
+        numpy_layer_arn = self.node.try_get_context('numpy_layer_arn')
+
+        if not numpy_layer_arn:
+            return []
+
+        return [self.node.try_find_child('NumPyLayer') or
+                _lambda.LayerVersion.from_layer_version_arn(self, 'NumPyLayer', numpy_layer_arn)]
+
     def _create_termination_function(self):
         # Create the Lambda function that implements the custom termination policy
         function = _lambda.Function(self, 'Function',
@@ -84,10 +109,8 @@ class MetricBasedTerminationStack(Stack):
                                     code=_lambda.Code.from_asset('metric_based_termination/assets/func_termination_policy'),
                                     timeout=Duration.minutes(5),
                                     handler='index.lambda_handler',
-                                    environment={'METRIC_NAME': 'CPUUtilization',
-                                                 'METRIC_THRESHOLD': '3',
-                                                 'METRIC_STAT': 'Minimum',
-                                                 'METRIC_TIME_WINDOW_IN_MINUTES': '5'}
+                                    layers=self._get_layers(),
+                                    environment=self._get_policy_environment()
                                     )
 
         # Grant the function permission to retrieve CloudWatch metrics
@@ -113,6 +136,51 @@ class MetricBasedTerminationStack(Stack):
 
         return function
 
+    def _create_snapshot_function(self, termination_function, auto_scaling_group):
+        # Table that holds one compressed snapshot of the instance metrics per ASG
+        table = dynamodb.Table(self, 'SnapshotTable',
+                               partition_key=dynamodb.Attribute(name='AutoScalingGroupName',
+                                                                type=dynamodb.AttributeType.STRING),
+                               billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                               removal_policy=RemovalPolicy.DESTROY)
+
+        snapshot_store = 'dynamodb://{}'.format(table.table_name)
+
+        # Create the Lambda function that refreshes the snapshot, sharing the code and configuration of the policy
+        environment = self._get_policy_environment()
+        environment.update({'METRIC_SNAPSHOT_STORE': snapshot_store,
+                            'METRIC_CACHE_TTL_IN_SECONDS': '0',
+                            'AUTO_SCALING_GROUP_NAME': auto_scaling_group.ref})
+
+        function = _lambda.Function(self, 'SnapshotFunction',
+                                    runtime=_lambda.Runtime.PYTHON_3_9,
+                                    function_name='customTerminationPolicySnapshot',
+                                    code=_lambda.Code.from_asset('metric_based_termination/assets/func_termination_policy'),
+                                    timeout=Duration.minutes(1),
+                                    handler='index.snapshot_handler',
+                                    layers=self._get_layers(),
+                                    environment=environment
+                                    )
+
+        # Grant the function permission to retrieve CloudWatch metrics and the instances of the ASG
+        function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            resources=['*'],
+            actions=['cloudwatch:GetMetricData',
+                     'autoscaling:DescribeAutoScalingGroups']
+        ))
+
+        table.grant_write_data(function)
+
+        # Let the termination policy read the snapshot instead of retrieving metrics
+        table.grant_read_data(termination_function)
+        termination_function.add_environment('METRIC_SNAPSHOT_STORE', snapshot_store)
+
+        # Refresh the snapshot every minute
+        events.Rule(self, 'SnapshotSchedule',
+                    schedule=events.Schedule.rate(Duration.minutes(1)),
+                    targets=[targets.LambdaFunction(function)])
+
     def _create_asg(self, launch_template, termination_function, vpc):
         # Define ASG configuration parameters
         asg_name = CfnParameter(self, "ASGName", type='String', description="ASG Name", default='Example ASG')
@@ -172,6 +240,8 @@ class MetricBasedTerminationStack(Stack):
             ))
         scaling_policy.node.add_dependency(l1_asg)
 
+        return l1_asg
+
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
@@ -185,4 +255,8 @@ class MetricBasedTerminationStack(Stack):
 
         # Create the custom termination policy using a Lambda function and an ASG that uses it
         termination_function = self._create_termination_function()
-        self._create_asg(launch_template, termination_function, vpc)
+        auto_scaling_group = self._create_asg(launch_template, termination_function, vpc)
+
+        # Optionally precompute the metrics of the instances out of band, so scale-in does not wait for CloudWatch
+        if self.node.try_get_context('metric_snapshot') in (True, 'true'):
+            self._create_snapshot_function(termination_function, auto_scaling_group)
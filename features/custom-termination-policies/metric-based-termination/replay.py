@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""Replays termination events against the custom termination policy without an Auto Scaling group,
+answering CloudWatch calls from recorded or synthetic metric series, and reports decision latency,
+API calls per decision and decision quality for a range of fleet sizes
+
+Usage:
+    python replay.py --fleet-sizes 10 100 1000 10000 --env METRIC_SAMPLING=series
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+POLICY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'metric_based_termination', 'assets', 'func_termination_policy')
+
+# Configuration deployed by the stack, overridden with --env
+POLICY_ENVIRONMENT = {
+    'METRIC_NAME': 'CPUUtilization',
+    'METRIC_THRESHOLD': '3',
+    'METRIC_STAT': 'Minimum',
+    'METRIC_TIME_WINDOW_IN_MINUTES': '5',
+    'METRIC_CACHE_TTL_IN_SECONDS': '0'
+}
+
+# Synthetic workload profiles with their share of the fleet, every profile returns the per-minute values
+# of the metric, newest first, and the seconds the instance would be busy during the next horizon
+PROFILES = {
+    'idle': 0.5,
+    'between_requests': 0.2,
+    'busy': 0.2,
+    'ramping': 0.1
+}
+
+
+def generate_profile(profile, minutes, horizon, rng):
+    """Returns the per-minute values of a synthetic instance, newest first,
+    and the seconds it would be busy during the horizon if it was not terminated
+
+    Keyword arguments:
+    profile -- name of the workload profile
+    minutes -- number of minutes of metric data
+    horizon -- seconds after the decision used to measure the work that is lost
+    rng -- random number generator
+    """
+
+    if profile == 'idle':
+        return [rng.uniform(0.1, 2) for _ in range(minutes)], 0
+    elif profile == 'between_requests':
+        # Busy for most of the window, but quiet during the last minutes
+        quiet = rng.randint(1, max(1, minutes // 3))
+        values = [rng.uniform(0.5, 2) for _ in range(quiet)] + [rng.uniform(40, 80) for _ in range(minutes - quiet)]
+        return values, int(horizon * 0.8)
+    elif profile == 'ramping':
+        # Still below the usual thresholds but increasing every minute
+        return [max(0.1, 2.5 - 0.5 * minute + rng.uniform(-0.2, 0.2)) for minute in range(minutes)], int(horizon * 0.6)
+
+    return [rng.uniform(30, 90) for _ in range(minutes)], horizon
+
+
+def generate_events(fleet_size, count, capacity, zones, minutes, horizon, rng):
+    """Returns synthetic recordings, each with a termination event, the metric series of every instance
+    and the seconds every instance would be busy during the horizon
+
+    Keyword arguments:
+    fleet_size -- number of instances in every event
+    count -- number of events
+    capacity -- fraction of the fleet to terminate
+    zones -- number of availability zones
+    minutes -- number of minutes of metric data
+    horizon -- seconds after the decision used to measure the work that is lost
+    rng -- random number generator
+    """
+
+    recordings = []
+
+    for event_index in range(count):
+        instances, series, busy_seconds = [], {}, {}
+
+        for index in range(fleet_size):
+            instance_id = 'i-{:08x}{:09x}'.format(event_index, index)
+            profile = rng.choices(list(PROFILES), weights=list(PROFILES.values()))[0]
+
+            instances.append({'InstanceId': instance_id, 'AvailabilityZone': 'zone-{}'.format(index % zones)})
+            series[instance_id], busy_seconds[instance_id] = generate_profile(profile, minutes, horizon, rng)
+
+        per_zone = max(1, int(fleet_size * capacity / zones)) if fleet_size * capacity >= 1 else 0
+
+        recordings.append({
+            'Event': {
+                'AutoScalingGroupARN': 'arn:aws:autoscaling:us-east-1:123456789012:autoScalingGroup:replay:'
+                                       'autoScalingGroupName/replay-{}'.format(fleet_size),
+                'Instances': instances,
+                'CapacityToTerminate': [
+                    {'AvailabilityZone': 'zone-{}'.format(zone), 'Capacity': per_zone} for zone in range(zones)
+                ],
+                'Cause': 'SCALE_IN'
+            },
+            'Series': series,
+            'BusySeconds': busy_seconds
+        })
+
+    return recordings
+
+
+def load_recordings(file):
+    """Loads recordings from a JSON lines file, every line holding an Event received by the policy,
+    the Series of every instance with per-minute values newest first, and optionally its BusySeconds
+
+    Keyword arguments:
+    file -- path of the recordings file
+    """
+
+    with open(file) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+def aggregate(values, stat):
+    """Aggregates data points with a CloudWatch statistic, percentiles are approximated by the nearest rank
+
+    Keyword arguments:
+    values -- list of values
+    stat -- name of the statistic
+    """
+
+    if stat == 'Minimum':
+        return min(values)
+    elif stat == 'Maximum':
+        return max(values)
+    elif stat == 'Sum':
+        return sum(values)
+    elif stat.startswith('p'):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * float(stat[1:]) / 100))]
+
+    return sum(values) / len(values)
+
+
+class SimulatedCloudWatch:
+    """Answers GetMetricData calls from the series of the current recording, without sending any request
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.series = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.queries = 0
+
+    def register(self, session):
+        """Registers the handlers on a botocore session, clients created from it inherit them
+
+        Keyword arguments:
+        session -- botocore session
+        """
+
+        session.events.register('before-parameter-build.cloudwatch', self.capture_params)
+        session.events.register('before-call.cloudwatch', self.respond)
+
+    def capture_params(self, params, context, **kwargs):
+        """Keeps the parameters of the call, which are no longer available once they are serialized
+        """
+
+        context['replay_params'] = dict(params)
+
+    def get_data_points(self, instance_id, stat, period, end_time):
+        """Returns the timestamps and values of an instance, newest first, for a statistic and period
+
+        Keyword arguments:
+        instance_id -- id of the instance
+        stat -- name of the statistic
+        period -- the granularity of the data points
+        end_time -- time stamp of the last data point that was requested
+        """
+
+        minutes = self.series[instance_id]
+        buckets = max(1, len(minutes) * 60 // period)
+        timestamps, values = [], []
+
+        for bucket in range(buckets):
+            first = bucket * period // 60
+            last = max(first + 1, (bucket + 1) * period // 60)
+            timestamps.append(end_time - datetime.timedelta(seconds=bucket * period + 1))
+            values.append(aggregate(minutes[first:last], stat))
+
+        return timestamps, values
+
+    def respond(self, model, context, **kwargs):
+        """Returns the response of a GetMetricData call, which prevents botocore from sending the request
+        """
+
+        from botocore.awsrequest import AWSResponse
+
+        time.sleep(self.latency / 1000.0)
+        params = context.get('replay_params', {})
+        results = []
+
+        for query in params.get('MetricDataQueries', []):
+            if 'MetricStat' in query:
+                instance_id = query['MetricStat']['Metric']['Dimensions'][0]['Value']
+                stat, period = query['MetricStat']['Stat'], query['MetricStat']['Period']
+                labels = [instance_id] if instance_id in self.series else []
+            else:
+                # SEARCH('{Namespace,InstanceId} MetricName="name"', 'stat', period) returns at most 500 time series
+                arguments = query['Expression'].rsplit(',', 2)
+                stat, period = arguments[1].strip(" '"), int(arguments[2].strip(' )'))
+                labels = list(self.series)[:500]
+
+            for label in labels:
+                timestamps, values = self.get_data_points(label, stat, period, params['EndTime'])
+                results.append({'Id': query['Id'], 'Label': label, 'Timestamps': timestamps,
+                                'Values': values, 'StatusCode': 'Complete'})
+
+        with self.lock:
+            self.calls += 1
+            self.queries += len(params.get('MetricDataQueries', []))
+
+        return AWSResponse(None, 200, {}, None), {'MetricDataResults': results, 'Messages': []}
+
+
+class ReplayContext:
+    """Stands in for the Lambda context object, with the timeout of the deployed function
+    """
+
+    def __init__(self, timeout_in_millis=300000):
+        self.deadline = time.monotonic() + timeout_in_millis / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def percentile(values, rank):
+    """Returns the nearest rank percentile of a list of values
+
+    Keyword arguments:
+    values -- list of values
+    rank -- percentile between 0 and 100
+    """
+
+    ordered = sorted(values)
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * rank / 100))] if ordered else 0
+
+
+def replay(index, cloudwatch, recordings, horizon):
+    """Invokes the policy with every recording and returns the measurements of the decisions
+
+    Keyword arguments:
+    index -- termination policy module
+    cloudwatch -- SimulatedCloudWatch answering the metric retrievals
+    recordings -- list of recordings
+    horizon -- seconds after the decision used to measure the work that is lost
+    """
+
+    latencies, calls, queries, killed, shortfalls = [], [], [], [], []
+
+    for recording in recordings:
+        cloudwatch.series = recording['Series']
+        calls_before, queries_before = cloudwatch.calls, cloudwatch.queries
+        event = json.loads(json.dumps(recording['Event']))
+
+        start = time.perf_counter()
+        response = index.lambda_handler(event, ReplayContext())
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        calls.append(cloudwatch.calls - calls_before)
+        queries.append(cloudwatch.queries - queries_before)
+
+        # Work lost by terminating busy instances, instances without a known future are assumed busy
+        busy_seconds = recording.get('BusySeconds', {})
+        killed.append(sum(busy_seconds.get(instance_id, horizon) for instance_id in response['InstanceIDs']))
+        shortfalls.append(sum(capacity['Capacity'] for capacity in recording['Event']['CapacityToTerminate']) -
+                          len(response['InstanceIDs']))
+
+    return {
+        'decisions': len(recordings),
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p90_ms': percentile(latencies, 90),
+        'latency_p99_ms': percentile(latencies, 99),
+        'api_calls_per_decision': statistics.mean(calls),
+        'queries_per_decision': statistics.mean(queries),
+        'killed_busy_seconds_per_decision': statistics.mean(killed),
+        'shortfall_per_decision': statistics.mean(shortfalls)
+    }
+
+
+def check_baseline(results, baseline_file, tolerance):
+    """Returns the regressions of the results against a baseline produced by a previous run:
+    latency percentiles beyond the tolerance, and more busy seconds killed or a larger shortfall
+
+    Keyword arguments:
+    results -- dictionary with the measurements of every fleet size
+    baseline_file -- path of the JSON file saved with --output
+    tolerance -- relative increase of latency that is accepted
+    """
+
+    with open(baseline_file) as fd:
+        baseline = json.load(fd)['results']
+
+    regressions = []
+
+    for fleet_size, measurements in results.items():
+        expected = baseline.get(fleet_size)
+
+        if expected is None:
+            continue
+
+        for key in ('latency_p50_ms', 'latency_p99_ms'):
+            if measurements[key] > expected[key] * (1 + tolerance):
+                regressions.append('{} instances: {} {:.1f} > {:.1f}'.format(fleet_size, key, measurements[key], expected[key]))
+
+        for key in ('killed_busy_seconds_per_decision', 'shortfall_per_decision', 'api_calls_per_decision'):
+            if measurements[key] > expected[key]:
+                regressions.append('{} instances: {} {:.1f} > {:.1f}'.format(fleet_size, key, measurements[key], expected[key]))
+
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay termination events against the custom termination policy.')
+    parser.add_argument('-n', '--fleet-sizes', help='Number of instances per event for synthetic events.',
+                        type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('-e', '--events', help='Number of synthetic events per fleet size.', type=int, default=20)
+    parser.add_argument('-c', '--capacity', help='Fraction of the fleet to terminate.', type=float, default=0.5)
+    parser.add_argument('-z', '--zones', help='Number of availability zones.', type=int, default=3)
+    parser.add_argument('-l', '--latency', help='Simulated latency of each GetMetricData call in milliseconds.',
+                        type=float, default=50)
+    parser.add_argument('-H', '--horizon', help='Seconds after a decision used to measure the work that is lost.',
+                        type=int, default=300)
+    parser.add_argument('-r', '--recordings', help='JSON lines file with recorded events, replayed instead of synthetic ones.')
+    parser.add_argument('-E', '--env', help='Policy configuration as NAME=VALUE, such as METRIC_SAMPLING=series.',
+                        action='append', default=[])
+    parser.add_argument('-s', '--seed', help='Seed of the synthetic events, so runs are reproducible.', type=int, default=42)
+    parser.add_argument('-o', '--output', help='Saves the results to a JSON file that can be used as baseline.')
+    parser.add_argument('-b', '--baseline', help='Fails when the results regress against a previous output file.')
+    parser.add_argument('-t', '--tolerance', help='Relative latency increase accepted against the baseline.',
+                        type=float, default=0.2)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The policy reads its configuration when imported, and no AWS credentials are needed
+    os.environ.update(POLICY_ENVIRONMENT)
+    os.environ.update(dict(variable.split('=', 1) for variable in args.env))
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'replay', 'AWS_SECRET_ACCESS_KEY': 'replay', 'AWS_DEFAULT_REGION': 'us-east-1'})
+    os.environ.pop('AWS_PROFILE', None)
+    os.environ.pop('AWS_SESSION_TOKEN', None)
+
+    import boto3
+
+    boto3.setup_default_session()
+    cloudwatch = SimulatedCloudWatch(args.latency)
+    cloudwatch.register(boto3.DEFAULT_SESSION)
+
+    sys.path.insert(0, POLICY_DIRECTORY)
+    import index
+
+    # The decisions are printed by the policy, keep them out of the report
+    stdout = sys.stdout
+    rng = random.Random(args.seed)
+    results = {}
+
+    if args.recordings:
+        groups = {'recorded': load_recordings(args.recordings)}
+    else:
+        groups = {
+            str(fleet_size): generate_events(fleet_size, args.events, args.capacity, args.zones,
+                                             index.METRIC_TIME_WINDOW_IN_MINUTES, args.horizon, rng)
+            for fleet_size in args.fleet_sizes
+        }
+
+    for name, recordings in groups.items():
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            try:
+                results[name] = replay(index, cloudwatch, recordings, args.horizon)
+            finally:
+                sys.stdout = stdout
+
+        print('{:>10} instances: p50 {latency_p50_ms:8.1f} ms  p90 {latency_p90_ms:8.1f} ms  p99 {latency_p99_ms:8.1f} ms  '
+              'calls {api_calls_per_decision:6.1f}  queries {queries_per_decision:8.1f}  '
+              'busy seconds killed {killed_busy_seconds_per_decision:10.1f}  shortfall {shortfall_per_decision:6.1f}'
+              .format(name, **results[name]))
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump({'configuration': {key: os.environ[key] for key in sorted(os.environ) if key.startswith('METRIC_')},
+                       'results': results}, fd, indent=2)
+
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.tolerance)
+
+        for regression in regressions:
+            print('Regression: {}'.format(regression))
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('METRIC_NAME', 'CPUUtilization')
+os.environ.setdefault('METRIC_THRESHOLD', '5')
+os.environ.setdefault('METRIC_STAT', 'Average')
+os.environ.setdefault('METRIC_TIME_WINDOW_IN_MINUTES', '10')
+os.environ.setdefault('INSTRUMENTATION', 'off')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'metric_based_termination', 'assets', 'func_termination_policy'))
+
+import index  # noqa: E402
+
+from botocore.exceptions import ClientError, EndpointConnectionError  # noqa: E402
+
+
+class FailingSnapshotStore:
+    """Snapshot store whose reads fail with the given error
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+    def load(self, group_name):
+        raise self.error
+
+
+@pytest.mark.parametrize('error', [
+    ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Throttled'}}, 'GetItem'),
+    EndpointConnectionError(endpoint_url='https://dynamodb.us-east-1.amazonaws.com'),
+    ValueError('Corrupt snapshot'),
+])
+def test_load_snapshot_falls_back_when_the_store_fails(monkeypatch, error):
+    monkeypatch.setattr(index, 'snapshot_store', FailingSnapshotStore(error))
+    monkeypatch.setattr(index, 'embedded_metrics', index.EmbeddedMetrics('Test'))
+
+    assert index.load_snapshot('group') == {}
+    assert index.embedded_metrics.values['SnapshotErrors'] == [1]
+
+
+class SlowCloudWatch:
+    """CloudWatch client whose GetMetricData calls block until released, returning no data points
+    """
+
+    def __init__(self):
+        self.released = threading.Event()
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, **kwargs):
+        self.released.wait(10)
+        return [{'MetricDataResults': []}]
+
+
+class Context:
+
+    def __init__(self, remaining_time_in_millis):
+        self.remaining_time_in_millis = remaining_time_in_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_in_millis
+
+
+def get_event(instance_id):
+    return {
+        'AutoScalingGroupARN': 'arn:aws:autoscaling:us-east-1:123456789012:autoScalingGroup:uuid:autoScalingGroupName/group',
+        'CapacityToTerminate': [{'AvailabilityZone': 'us-east-1a', 'Capacity': 1}],
+        'Instances': [{'InstanceId': instance_id, 'AvailabilityZone': 'us-east-1a'}],
+        'Cause': 'SCALE_IN'
+    }
+
+
+def test_retrieval_outlasting_the_deadline_does_not_write_to_the_next_invocation(monkeypatch, capsys):
+    cloudwatch = SlowCloudWatch()
+    monkeypatch.setattr(index, 'cloudwatch', cloudwatch)
+    monkeypatch.setattr(index, 'INSTRUMENTATION', 'summary')
+    monkeypatch.setattr(index, 'INSTANCE_DUMP_SAMPLE_RATE', 0)
+
+    # The First Invocation Answers Once its Deadline Passes, Before its Retrieval Completes
+    index.lambda_handler(get_event('i-00000000000000001'), Context(index.METRIC_DEADLINE_MARGIN_IN_MILLISECONDS + 50))
+    late_metrics = index.embedded_metrics
+    cloudwatch.released.set()
+
+    deadline = time.monotonic() + 10
+    while 'GetMetricDataPages' not in late_metrics.values and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert late_metrics.values['GetMetricDataPages'] == [1]
+
+    index.lambda_handler(get_event('i-00000000000000002'), Context(60000))
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+
+    assert [record['PendingInstances'] for record in records] == [[1], [0]]
+    assert 'GetMetricDataPages' not in records[0]
+    assert records[1]['GetMetricDataPages'] == [1]
+
+
+
+def test_abandoned_retrieval_does_not_hold_a_worker_of_the_next_invocation(monkeypatch, capsys):
+    slow_cloudwatch = SlowCloudWatch()
+    monkeypatch.setattr(index, 'cloudwatch', slow_cloudwatch)
+    monkeypatch.setattr(index, 'INSTRUMENTATION', 'summary')
+    monkeypatch.setattr(index, 'INSTANCE_DUMP_SAMPLE_RATE', 0)
+
+    try:
+        # As Many Invocations as There are Workers Abandon a Retrieval That is Still Blocked
+        for number in range(index.METRIC_DATA_MAX_WORKERS):
+            index.lambda_handler(get_event('i-1{:016d}'.format(number)),
+                                 Context(index.METRIC_DEADLINE_MARGIN_IN_MILLISECONDS + 50))
+
+        fast_cloudwatch = SlowCloudWatch()
+        fast_cloudwatch.released.set()
+        monkeypatch.setattr(index, 'cloudwatch', fast_cloudwatch)
+        index.lambda_handler(get_event('i-00000000000000003'), Context(index.METRIC_DEADLINE_MARGIN_IN_MILLISECONDS + 2000))
+    finally:
+        slow_cloudwatch.released.set()
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert [record['PendingInstances'] for record in records] == [[1]] * index.METRIC_DATA_MAX_WORKERS + [[0]]
+
+
+def test_weighted_score_leaves_instances_without_data_out_of_the_bounds():
+    instances = [
+        {'InstanceId': 'i-busy', 'AvailabilityZone': 'us-east-1a', 'Metrics': {'CPUUtilization': 3}, 'Pending': False},
+        {'InstanceId': 'i-pending', 'AvailabilityZone': 'us-east-1a', 'Metrics': {'CPUUtilization': 0}, 'Pending': True},
+        {'InstanceId': 'i-no-data', 'AvailabilityZone': 'us-east-1a', 'Metrics': {'CPUUtilization': 0}, 'Pending': False,
+         'NoData': ['CPUUtilization']},
+        {'InstanceId': 'i-idle', 'AvailabilityZone': 'us-east-1a', 'Metrics': {'CPUUtilization': 1}, 'Pending': False},
+    ]
+
+    scores, eligible, complete = index.score_instances(instances)
+
+    # Bounds come from the instances with data only, so the idle instance scores 0 and the busy one 1
+    assert scores[[0, 3]].tolist() == [1, 0]
+    assert eligible.tolist() == [True, False, True, True]
+    assert complete.tolist() == [True, False, False, True]
+
+    # Instances without data points are still eligible, but only selected after every instance with data
+    assert index.select_instances_by_score(instances, {'us-east-1a': 3}) == ['i-idle', 'i-busy', 'i-no-data']
+
+
+@pytest.mark.parametrize('strategy', sorted(index.SELECTION_STRATEGIES))
+def test_every_strategy_ranks_instances_without_data_last(strategy):
+    instances = [
+        {'InstanceId': 'i-no-data', 'AvailabilityZone': 'us-east-1a', 'Metrics': {'CPUUtilization': 0}, 'Pending': False,
+         'NoData': ['CPUUtilization']},
+        {'InstanceId': 'i-idle', 'AvailabilityZone': 'us-east-1a', 'Metrics': {'CPUUtilization': 1}, 'Pending': False,
+         'NoData': []},
+    ]
+
+    assert index.SELECTION_STRATEGIES[strategy](instances, {'us-east-1a': 1}) == ['i-idle']
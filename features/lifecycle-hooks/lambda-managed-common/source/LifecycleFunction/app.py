@@ -0,0 +1,664 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import boto3
+import hashlib
+import os
+import json
+import logging
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+autoscaling = boto3.client('autoscaling')
+ec2 = boto3.client('ec2')
+ssm = boto3.client('ssm')
+
+# Either 'poll' to Wait for Commands Within the Function, or 'async' to Dispatch Them and Complete
+# the Lifecycle Action From command_status_handler When SSM Reports the Command Status
+command_mode = os.environ.get('COMMAND_MODE', 'async')
+
+# Store Correlating Command IDs With Lifecycle Action Tokens, dynamodb://table-name or file:///path
+state_store_url = os.environ.get('STATE_STORE', '')
+state_ttl_seconds = int(os.environ.get('STATE_TTL_SECONDS', '7200'))
+
+# Polling Starts Right Away and Backs Off Exponentially up to the Maximum Interval
+poll_initial_interval_seconds = float(os.environ.get('POLL_INITIAL_INTERVAL_SECONDS', '1'))
+poll_max_interval_seconds = float(os.environ.get('POLL_MAX_INTERVAL_SECONDS', '30'))
+
+# SendCommand is Retried While a New Instance Registers With SSM, Waiting a Little Longer After Each Attempt
+send_command_attempts = int(os.environ.get('SEND_COMMAND_ATTEMPTS', '10'))
+send_command_interval_seconds = float(os.environ.get('SEND_COMMAND_INTERVAL_SECONDS', '5'))
+
+# Most Instances a Single SendCommand Call Can Target
+max_instances_per_command = min(int(os.environ.get('MAX_INSTANCES_PER_COMMAND', '50')), 50)
+
+# Seconds Between Lifecycle Action Heartbeats, Keep it Well Below the Hook's HeartbeatTimeout
+heartbeat_interval_seconds = float(os.environ.get('HEARTBEAT_INTERVAL_SECONDS', '300'))
+
+# Seconds Reserved at the End of the Invocation to Complete the Lifecycle Action
+deadline_margin_seconds = float(os.environ.get('DEADLINE_MARGIN_SECONDS', '10'))
+
+# Ledger of Bootstrap Steps Completed on Each Instance, tags, dynamodb://table-name, file:///path or none
+ledger_store_url = os.environ.get('LEDGER_STORE', 'tags')
+
+# Catalog of Bootstrap Steps per Platform, file://catalog.json Bundled With the Function or ssm://parameter-name
+catalog_url = os.environ.get('CATALOG', 'file://catalog.json')
+catalog_ttl_seconds = float(os.environ.get('CATALOG_TTL_SECONDS', '300'))
+platform = os.environ.get('PLATFORM', 'linux')
+
+# Catalog Kept Across Warm Invocations Until it Expires
+catalog_cache = {'Catalog': None, 'ExpiresAt': 0}
+
+# Command Invocation Statuses That Are Not Final
+pending_statuses = ['Pending', 'InProgress', 'Delayed']
+
+# Lifecycle Action Fields Needed to Complete it Later
+lifecycle_fields = ['LifecycleHookName', 'AutoScalingGroupName', 'LifecycleActionToken', 'EC2InstanceId']
+
+# Command ID Stored in Place of the Real One While a Command is Being Sent to an Instance
+dispatching_command_id = 'Dispatching'
+
+# Keeps Each Pending Lifecycle Action as a JSON File, Useful for Local Testing
+class FileStateStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_file(self, command_id, instance_id):
+        return os.path.join(self.path, '{}_{}.json'.format(command_id, instance_id))
+
+    def put(self, command_id, instance_id, state):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.get_file(command_id, instance_id), 'w') as fd:
+            json.dump(state, fd)
+
+    def get(self, command_id, instance_id):
+        try:
+            with open(self.get_file(command_id, instance_id)) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, command_id, instance_id):
+        try:
+            os.remove(self.get_file(command_id, instance_id))
+        except FileNotFoundError:
+            pass
+
+# Keeps Each Pending Lifecycle Action as an Item Keyed by CommandId and InstanceId, Expired by ExpiresAt
+class DynamoDBStateStore:
+
+    def __init__(self, table_name):
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def put(self, command_id, instance_id, state):
+        item = dict(state, CommandId=command_id, InstanceId=instance_id, ExpiresAt=int(time.time()) + state_ttl_seconds)
+        self.table.put_item(Item=item)
+
+    def get(self, command_id, instance_id):
+        item = self.table.get_item(Key={'CommandId': command_id, 'InstanceId': instance_id}, ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        state = {field: item[field] for field in lifecycle_fields}
+        state['Steps'] = item.get('Steps', {})
+        return state
+
+    def delete(self, command_id, instance_id):
+        self.table.delete_item(Key={'CommandId': command_id, 'InstanceId': instance_id})
+
+def get_state_store(url):
+    if url.startswith('dynamodb://'):
+        return DynamoDBStateStore(url[len('dynamodb://'):])
+    if url.startswith('file://'):
+        return FileStateStore(url[len('file://'):])
+    if command_mode == 'async':
+        raise Exception('COMMAND_MODE async requires STATE_STORE, got: {}'.format(url))
+    return None
+
+state_store = get_state_store(state_store_url)
+
+# Records Completed Steps as Instance Tags, so the Ledger Follows the Instance in and out of the Warm Pool
+class TagLedgerStore:
+
+    prefix = 'LifecycleStep:'
+
+    def get(self, instance_id):
+        response = ec2.describe_tags(
+            Filters=[
+                {'Name': 'resource-id', 'Values': [instance_id]},
+                {'Name': 'key', 'Values': [self.prefix + '*']}
+            ]
+        )
+        return {tag['Key'][len(self.prefix):]: tag['Value'] for tag in response['Tags']}
+
+    def put(self, instance_id, steps):
+        ec2.create_tags(
+            Resources=[instance_id],
+            Tags=[{'Key': self.prefix + name, 'Value': step_hash} for name, step_hash in steps.items()]
+        )
+
+# Keeps the Completed Steps of Each Instance as a JSON File, Useful for Local Testing
+class FileLedgerStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, instance_id):
+        try:
+            with open(os.path.join(self.path, '{}.json'.format(instance_id))) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {}
+
+    def put(self, instance_id, steps):
+        os.makedirs(self.path, exist_ok=True)
+        steps = dict(self.get(instance_id), **steps)
+        with open(os.path.join(self.path, '{}.json'.format(instance_id)), 'w') as fd:
+            json.dump(steps, fd)
+
+# Keeps the Completed Steps of Each Instance as a Map in an Item Keyed by InstanceId
+class DynamoDBLedgerStore:
+
+    def __init__(self, table_name):
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def get(self, instance_id):
+        item = self.table.get_item(Key={'InstanceId': instance_id}, ConsistentRead=True).get('Item')
+        return item['Steps'] if item else {}
+
+    def put(self, instance_id, steps):
+        self.table.put_item(Item={'InstanceId': instance_id, 'Steps': dict(self.get(instance_id), **steps)})
+
+def get_ledger_store(url):
+    if url == 'tags':
+        return TagLedgerStore()
+    if url.startswith('dynamodb://'):
+        return DynamoDBLedgerStore(url[len('dynamodb://'):])
+    if url.startswith('file://'):
+        return FileLedgerStore(url[len('file://'):])
+    return None
+
+ledger_store = get_ledger_store(ledger_store_url)
+
+def load_catalog(url):
+    if url.startswith('ssm://'):
+        body = ssm.get_parameter(Name=url[len('ssm://'):])['Parameter']['Value']
+    elif url.startswith('file://'):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), url[len('file://'):])) as fd:
+            body = fd.read()
+    else:
+        raise Exception('Unsupported CATALOG: {}'.format(url))
+
+    catalog = json.loads(body)[platform]
+
+    # Join and Hash Each Step Once per Load Rather Than per Event
+    for name, step in catalog['Steps'].items():
+        step['Command'] = '\n'.join(step['Commands'])
+        step['Hash'] = hashlib.sha256(step['Command'].encode('utf-8')).hexdigest()[:16]
+        for dependency in step.get('DependsOn', []):
+            if dependency not in catalog['Steps']:
+                raise Exception('Step {} depends on unknown step {}'.format(name, dependency))
+    for transition, details in catalog['Transitions'].items():
+        for name in details['Steps']:
+            if name not in catalog['Steps']:
+                raise Exception('Transition {} uses unknown step {}'.format(transition, name))
+
+    return catalog
+
+def get_catalog():
+    now = time.time()
+    if catalog_cache['Catalog'] is None or now >= catalog_cache['ExpiresAt']:
+        try:
+            catalog_cache['Catalog'] = load_catalog(catalog_url)
+            logger.info('Loaded {} catalog from {}'.format(platform, catalog_url))
+        except Exception as e:
+            if catalog_cache['Catalog'] is None:
+                raise
+            logger.warning('Error refreshing the catalog, keeping the cached one: {}'.format(e))
+        catalog_cache['ExpiresAt'] = now + catalog_ttl_seconds
+    return catalog_cache['Catalog']
+
+# Ledger Entries to Record Once the Given Steps Have Run Successfully
+def get_step_hashes(steps):
+    catalog_steps = get_catalog()['Steps']
+    return {name: catalog_steps[name]['Hash'] for name in steps if catalog_steps[name]['Once']}
+
+# Drops the Steps the Ledger Shows as Completed With the Same Command
+def get_pending_steps(instance_id, steps):
+    if ledger_store is None:
+        return steps
+    try:
+        completed = ledger_store.get(instance_id)
+    except Exception as e:
+        logger.warning('Error reading the ledger of instance {}, running every step: {}'.format(instance_id, e))
+        return steps
+    catalog_steps = get_catalog()['Steps']
+    pending = [name for name in steps if not (catalog_steps[name]['Once'] and completed.get(name) == catalog_steps[name]['Hash'])]
+    if len(pending) < len(steps):
+        logger.info('Skipping steps already completed on instance {}: {}'.format(instance_id, [name for name in steps if name not in pending]))
+    return pending
+
+def record_steps(instance_id, step_hashes):
+    if ledger_store is None or not step_hashes:
+        return
+    try:
+        ledger_store.put(instance_id, step_hashes)
+    except Exception as e:
+        # The Steps Will Run Again Next Time, Which is Safe
+        logger.warning('Error recording steps {} for instance {}: {}'.format(list(step_hashes), instance_id, e))
+
+# Groups Steps Into Waves, Each Step Runs After the Steps it Depends on That are Still to Run,
+# Steps in the Same Wave are Independent and Run in Parallel
+def get_waves(steps):
+    catalog_steps = get_catalog()['Steps']
+    wave_of = {}
+    waves = []
+    for name in steps:
+        wave = max([wave_of[dependency] + 1 for dependency in catalog_steps[name].get('DependsOn', []) if dependency in wave_of], default=0)
+        wave_of[name] = wave
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(name)
+    return waves
+
+def get_shell_wave(commands):
+    if len(commands) == 1:
+        return commands
+    lines = []
+    for i, command in enumerate(commands):
+        lines.extend(['(', command, ') &', 'pid{}=$!'.format(i)])
+    lines.extend('wait $pid{}'.format(i) for i in range(len(commands)))
+    return lines
+
+# Native Commands Do Not Stop PowerShell When They Fail, so Their Exit Code is Checked After Each Step,
+# a Step Failing in a Job Throws so the Job Fails and the Wave Exits
+def get_powershell_wave(commands):
+    if len(commands) == 1:
+        return [commands[0], 'if ($LASTEXITCODE) { exit $LASTEXITCODE }']
+    jobs = ',\n'.join('(Start-Job -ScriptBlock {{\n{}\nif ($LASTEXITCODE) {{ throw "Exited with code $LASTEXITCODE" }}\n}})'.format(command) for command in commands)
+    return [
+        '$jobs = @(\n{}\n)'.format(jobs),
+        '$jobs | Wait-Job | Receive-Job',
+        'if ($jobs | Where-Object { $_.State -eq "Failed" }) { exit 1 }'
+    ]
+
+# Builds a Single Script Running the Waves in Order, With the Steps of Each Wave in Parallel
+def get_command(steps):
+    catalog = get_catalog()
+    lines = ['set -e'] if catalog['Shell'] == 'sh' else []
+    for wave in get_waves(steps):
+        commands = [catalog['Steps'][name]['Command'] for name in wave]
+        if catalog['Shell'] == 'sh':
+            lines.extend(get_shell_wave(commands))
+        else:
+            lines.extend(get_powershell_wave(commands))
+    return '\n'.join(lines)
+
+def send_lifecycle_action(event, result):
+    try:
+        response = autoscaling.complete_lifecycle_action(
+            LifecycleHookName=event['detail']['LifecycleHookName'],
+            AutoScalingGroupName=event['detail']['AutoScalingGroupName'],
+            LifecycleActionToken=event['detail']['LifecycleActionToken'],
+            LifecycleActionResult=result,
+            InstanceId=event['detail']['EC2InstanceId']
+        )
+
+        logger.info(response)
+    except ClientError as e:
+        message = 'Error completing lifecycle action: {}'.format(e)
+        logger.error(message)
+        raise Exception(message)
+    
+    return
+
+# Abandons a Lifecycle Action on a Best Effort Basis, it May Already be Completed or Have Expired
+def abandon_lifecycle_action(event):
+    try:
+        send_lifecycle_action(event, 'ABANDON')
+    except Exception:
+        pass
+
+def get_deadline(context):
+    # Leave Enough Time to Complete the Lifecycle Action Before Lambda Times Out
+    if context is None:
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - deadline_margin_seconds
+
+# Exponential Back-off With Equal Jitter, Starting From the Initial Interval
+def get_poll_interval(attempt, deadline):
+    interval = min(poll_max_interval_seconds, poll_initial_interval_seconds * 2 ** (attempt - 1))
+    interval = interval / 2 + random.uniform(0, interval / 2)
+    return cap_interval(interval, deadline)
+
+# Linear Back-off in Steps of the Interval, Jitter is Added on Top so Instances Get at Least the Full Window to Register
+def get_send_command_interval(attempt, deadline):
+    interval = send_command_interval_seconds * (attempt + 1) + random.uniform(0, send_command_interval_seconds)
+    return cap_interval(interval, deadline)
+
+# Never Sleeps Past the Deadline
+def cap_interval(interval, deadline):
+    if deadline is not None:
+        interval = min(interval, deadline - time.time())
+    return max(interval, 0)
+
+def record_lifecycle_action_heartbeat(event):
+    try:
+        response = autoscaling.record_lifecycle_action_heartbeat(
+            LifecycleHookName=event['detail']['LifecycleHookName'],
+            AutoScalingGroupName=event['detail']['AutoScalingGroupName'],
+            LifecycleActionToken=event['detail']['LifecycleActionToken'],
+            InstanceId=event['detail']['EC2InstanceId']
+        )
+
+        logger.info(response)
+    except ClientError as e:
+        # A Missed Heartbeat Only Shortens the Time Left, the Command Keeps Running
+        logger.warning('Error recording lifecycle action heartbeat: {}'.format(e))
+
+    return
+
+def send_command(instance_ids, command, deadline=None):
+
+    # Run Command, Retrying While the Instances are Not Yet Registered With SSM or the Call is Throttled
+    logger.info('Calling SendCommand: {} for instances: {}'.format(command, instance_ids))
+    attempt = 0
+    while True:
+        attempt = attempt + 1
+        try:
+            logger.info('SendCommand, attempt #: {}'.format(attempt))
+            response = ssm.send_command(
+                InstanceIds=instance_ids,
+                DocumentName=get_catalog()['DocumentName'],
+                Parameters={
+                    'commands': [
+                        command
+                    ]
+                }
+            )
+
+            logger.info(response)
+            return response['Command']['CommandId']
+
+        except ClientError as e:
+            message = 'Error calling SendCommand: {}'.format(e)
+            logger.error(message)
+            if attempt == send_command_attempts or (deadline is not None and time.time() >= deadline):
+                raise Exception(message)
+
+        time.sleep(get_send_command_interval(attempt, deadline))
+
+def run_command(event, command, context=None):
+
+    deadline = get_deadline(context)
+    command_id = send_command([event['detail']['EC2InstanceId']], command, deadline)
+
+    # Check Command Status, Starting Right Away and Backing Off While it Runs
+    logger.info('Calling GetCommandInvocation for command: {} for instance: {}'.format(command_id, event['detail']['EC2InstanceId']))
+    attempt = 0
+    last_heartbeat = time.time()
+
+    while True:
+        attempt = attempt + 1
+        try:
+            logger.info('GetCommandInvocation, attempt #: {}'.format(attempt))
+            result = ssm.get_command_invocation(
+                CommandId=command_id,
+                InstanceId=event['detail']['EC2InstanceId'],
+            )
+            if result['Status'] == 'Success':
+                logger.info('Command completed successfully: {}'.format(result['StandardOutputContent']))
+                return
+            elif result['Status'] in pending_statuses:
+                logger.info('Command is {}.'.format(result['Status']))
+            else:
+                message = 'Command did not execute successfully, status {}: {}'.format(result['Status'], result['StandardErrorContent'])
+                logger.error(message)
+                raise Exception(message)
+        except ssm.exceptions.InvocationDoesNotExist as e:
+            # The Invocation Can Take a Moment to Appear After SendCommand Returns
+            logger.info('Command invocation is not available yet: {}'.format(e))
+
+        if deadline is not None and time.time() >= deadline:
+            message = 'Command did not execute succesfully in time allowed.'
+            raise Exception(message)
+
+        # Extend the Lifecycle Action so a Long Running Command is Not Abandoned by the Heartbeat Timeout
+        if time.time() - last_heartbeat >= heartbeat_interval_seconds:
+            logger.info('Recording lifecycle action heartbeat for instance: {}'.format(event['detail']['EC2InstanceId']))
+            record_lifecycle_action_heartbeat(event)
+            last_heartbeat = time.time()
+
+        time.sleep(get_poll_interval(attempt, deadline))
+
+# Waits for a Command Sent to Several Instances and Completes Each Lifecycle Action as its Invocation Finishes
+def wait_for_commands(command_id, events, deadline, step_hashes):
+
+    pending = {event['detail']['EC2InstanceId']: event for event in events}
+    logger.info('Calling ListCommandInvocations for command: {} for instances: {}'.format(command_id, list(pending)))
+    attempt = 0
+    last_heartbeat = time.time()
+
+    while pending:
+        attempt = attempt + 1
+        try:
+            logger.info('ListCommandInvocations, attempt #: {}'.format(attempt))
+            paginator = ssm.get_paginator('list_command_invocations')
+            for page in paginator.paginate(CommandId=command_id):
+                for invocation in page['CommandInvocations']:
+                    event = pending.get(invocation['InstanceId'])
+                    if event is None or invocation['Status'] in pending_statuses:
+                        continue
+                    result = 'CONTINUE' if invocation['Status'] == 'Success' else 'ABANDON'
+                    logger.info('Command finished with status {} on instance {}, completing lifecycle action with {}.'.format(invocation['Status'], invocation['InstanceId'], result))
+                    del pending[invocation['InstanceId']]
+                    if result == 'CONTINUE':
+                        record_steps(invocation['InstanceId'], step_hashes)
+                    try:
+                        send_lifecycle_action(event, result)
+                    except Exception as e:
+                        logger.error('Error completing lifecycle action for instance {}: {}'.format(invocation['InstanceId'], e))
+        except ClientError as e:
+            logger.error('Error calling ListCommandInvocations: {}'.format(e))
+
+        if not pending:
+            break
+
+        if deadline is not None and time.time() >= deadline:
+            message = 'Command did not execute succesfully in time allowed on instances: {}'.format(list(pending))
+            raise Exception(message)
+
+        if time.time() - last_heartbeat >= heartbeat_interval_seconds:
+            for event in pending.values():
+                record_lifecycle_action_heartbeat(event)
+            last_heartbeat = time.time()
+
+        time.sleep(get_poll_interval(attempt, deadline))
+
+    return
+
+# Sends One Command per Group of Instances and Completes Their Lifecycle Actions Individually
+def execute_commands(events, steps, context=None):
+
+    deadline = get_deadline(context)
+
+    if command_mode == 'async':
+        command_id = dispatch_command(events, steps, deadline)
+        logger.info('Command {} dispatched to {} instances, the lifecycle actions will be completed when it finishes.'.format(command_id, len(events)))
+    else:
+        instance_ids = [event['detail']['EC2InstanceId'] for event in events]
+        command_id = send_command(instance_ids, get_command(steps), deadline)
+        wait_for_commands(command_id, events, deadline, get_step_hashes(steps))
+
+# Sends a Command and Stores the Lifecycle Actions it Completes, Marking the Instances While it is Sent
+# so a Status Event Arriving Before the State is Stored Knows to Wait for it
+def dispatch_command(events, steps, deadline):
+    states = {}
+    for event in events:
+        state = {field: event['detail'][field] for field in lifecycle_fields}
+        state['Steps'] = get_step_hashes(steps)
+        states[event['detail']['EC2InstanceId']] = state
+        state_store.put(dispatching_command_id, event['detail']['EC2InstanceId'], state)
+
+    try:
+        command_id = send_command(list(states), get_command(steps), deadline)
+        for instance_id, state in states.items():
+            state_store.put(command_id, instance_id, state)
+    finally:
+        for instance_id in states:
+            state_store.delete(dispatching_command_id, instance_id)
+
+    return command_id
+
+# Dispatches the Command and Leaves the Lifecycle Action Pending in Async Mode, Otherwise Waits for the Command and Completes it
+def execute_command(event, steps, context=None):
+    if command_mode == 'async':
+        command_id = dispatch_command([event], steps, get_deadline(context))
+        logger.info('Command {} dispatched, the lifecycle action will be completed when it finishes.'.format(command_id))
+    else:
+        run_command(event, get_command(steps), context)
+        record_steps(event['detail']['EC2InstanceId'], get_step_hashes(steps))
+        send_lifecycle_action(event, 'CONTINUE')
+
+# Invoked by the EC2 Command Invocation Status-change Notification Events of SSM
+def command_status_handler(event, context):
+
+    logger.info(event)
+
+    command_id = event['detail']['command-id']
+    instance_id = event['detail']['instance-id']
+    status = event['detail']['status']
+
+    if status in pending_statuses:
+        logger.info('Command {} is {} on instance {}, waiting for a final status.'.format(command_id, status, instance_id))
+        return
+
+    # The Status of a Command That Fails Right Away Can Arrive Before its State is Stored,
+    # Only Wait for it While a Command is Being Sent to the Instance
+    state = state_store.get(command_id, instance_id)
+    attempt = 0
+    while state is None and attempt < 3 and state_store.get(dispatching_command_id, instance_id) is not None:
+        attempt = attempt + 1
+        time.sleep(attempt)
+        state = state_store.get(command_id, instance_id)
+
+    if state is None:
+        logger.info('Command {} was not dispatched for a lifecycle action, ignoring.'.format(command_id))
+        return
+
+    result = 'CONTINUE' if status == 'Success' else 'ABANDON'
+    logger.info('Command {} finished with status {} on instance {}, completing lifecycle action with {}.'.format(command_id, status, instance_id, result))
+    if result == 'CONTINUE':
+        record_steps(instance_id, state.get('Steps', {}))
+    send_lifecycle_action({'detail': state}, result)
+    state_store.delete(command_id, instance_id)
+
+    logger.info('Execution Complete')
+    return
+
+def get_steps(event):
+
+    transition = get_catalog()['Transitions'].get('{}:{}'.format(event['detail']['Origin'], event['detail']['Destination']))
+    if transition is None:
+        return None
+
+    logger.info(transition['Description'])
+    return get_pending_steps(event['detail']['EC2InstanceId'], transition['Steps'])
+
+# Invoked by the SQS Queue That Coalesces Lifecycle Events Arriving Within the Batching Window
+def batch_handler(event, context):
+
+    # Group Instances by the Steps They Still Need
+    groups = {}
+    for record in event['Records']:
+        lifecycle_event = json.loads(record['body'])
+        logger.info(lifecycle_event)
+
+        # One Record That Fails Must Not Fail the Whole Batch, or SQS Would Deliver Every Record Again
+        try:
+            steps = get_steps(lifecycle_event)
+            if steps is None:
+                logger.info('An unhandled lifecycle action occured, abandoning.')
+                send_lifecycle_action(lifecycle_event, 'ABANDON')
+                continue
+            if not steps:
+                logger.info('Every step is already completed on instance {}, continuing.'.format(lifecycle_event['detail']['EC2InstanceId']))
+                send_lifecycle_action(lifecycle_event, 'CONTINUE')
+                continue
+        except Exception as e:
+            logger.error('Error handling lifecycle action for instance {}: {}'.format(lifecycle_event['detail']['EC2InstanceId'], e))
+            abandon_lifecycle_action(lifecycle_event)
+            continue
+        groups.setdefault(tuple(steps), []).append(lifecycle_event)
+
+    # Send Each Group in Chunks of up to the SSM Target Limit, Running the Chunks Concurrently
+    batches = []
+    for steps, events in groups.items():
+        for i in range(0, len(events), max_instances_per_command):
+            batches.append((events[i:i + max_instances_per_command], list(steps)))
+
+    def run_batch(batch):
+        events, steps = batch
+        try:
+            execute_commands(events, steps, context)
+        except Exception as e:
+            message = 'Error running command: {}'.format(e)
+            logger.error(message)
+            for lifecycle_event in events:
+                abandon_lifecycle_action(lifecycle_event)
+
+    with ThreadPoolExecutor(max_workers=max(len(batches), 1)) as executor:
+        list(executor.map(run_batch, batches))
+
+    logger.info('Execution Complete')
+    return
+
+def lambda_handler(event, context):
+
+    logger.info(event)
+
+    # Lifecycle Events Delivered in Batches by SQS
+    if 'Records' in event:
+        return batch_handler(event, context)
+
+    steps = get_steps(event)
+    if steps is None:
+        logger.info('An unhandled lifecycle action occured, abandoning.')
+        send_lifecycle_action(event, 'ABANDON')
+        logger.info('Execution Complete')
+        return
+
+    if not steps:
+        logger.info('Every step is already completed on instance {}, continuing.'.format(event['detail']['EC2InstanceId']))
+        send_lifecycle_action(event, 'CONTINUE')
+        logger.info('Execution Complete')
+        return
+
+    try:
+        execute_command(event, steps, context)
+    except Exception as e:
+        message = 'Error running command: {}'.format(e)
+        logger.error(message)
+        send_lifecycle_action(event, 'ABANDON')
+    logger.info('Execution Complete')
+
+    # End
+    return
@@ -0,0 +1,225 @@
+# Runs the Lifecycle Function Against Stubbed AWS Clients and a Simulated Clock
+# Usage: python3 -m pytest tests
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ['COMMAND_MODE'] = 'poll'
+os.environ['LEDGER_STORE'] = 'none'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source', 'LifecycleFunction'))
+
+import pytest
+from botocore.stub import Stubber
+
+import app
+
+command_id = 'c' * 36
+
+# Time Only Moves Forward When the Function Sleeps
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class Context:
+
+    def __init__(self, clock, timeout):
+        self.clock = clock
+        self.expires_at = clock.now + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.expires_at - self.clock.now) * 1000)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app, 'time', clock)
+    return clock
+
+@pytest.fixture
+def ssm():
+    with Stubber(app.ssm) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+@pytest.fixture
+def autoscaling():
+    with Stubber(app.autoscaling) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+# Replaces the Bundled Catalog With Two Independent Steps That Succeed and One That Fails
+@pytest.fixture
+def catalog(monkeypatch, tmp_path):
+    def get_platform(document_name, shell, succeed, fail):
+        return {
+            'DocumentName': document_name,
+            'Shell': shell,
+            'Steps': {
+                'first': {'Commands': [succeed.format('first')], 'Once': True},
+                'second': {'Commands': [succeed.format('second')], 'Once': True},
+                'failing': {'Commands': [fail], 'Once': False}
+            },
+            'Transitions': {}
+        }
+
+    path = tmp_path / 'catalog.json'
+    path.write_text(json.dumps({
+        'linux': get_platform('AWS-RunShellScript', 'sh', 'echo {}', 'sh -c "exit 3"'),
+        'windows': get_platform('AWS-RunPowerShellScript', 'powershell', 'Write-Output {}', 'pwsh -NoProfile -Command "exit 3"')
+    }))
+    monkeypatch.setattr(app, 'catalog_url', 'file://{}'.format(path))
+    monkeypatch.setattr(app, 'catalog_cache', {'Catalog': None, 'ExpiresAt': 0})
+
+def run_script(shell, script):
+    if shell == 'sh':
+        return subprocess.run(['sh', '-c', script], capture_output=True, text=True)
+    return subprocess.run(['pwsh', '-NoProfile', '-NonInteractive', '-Command', script], capture_output=True, text=True)
+
+def get_event(instance_id='i-0123456789abcdef0', origin='EC2', destination='AutoScalingGroup'):
+    return {
+        'detail': {
+            'Origin': origin,
+            'Destination': destination,
+            'LifecycleHookName': 'LifecycleHook',
+            'AutoScalingGroupName': 'AutoScalingGroup',
+            'LifecycleActionToken': 't' * 36,
+            'EC2InstanceId': instance_id
+        }
+    }
+
+def get_lifecycle_params(event):
+    return {
+        'LifecycleHookName': event['detail']['LifecycleHookName'],
+        'AutoScalingGroupName': event['detail']['AutoScalingGroupName'],
+        'LifecycleActionToken': event['detail']['LifecycleActionToken'],
+        'InstanceId': event['detail']['EC2InstanceId']
+    }
+
+def test_heartbeat_is_recorded_while_polling(monkeypatch, clock, ssm, autoscaling):
+    monkeypatch.setattr(app, 'heartbeat_interval_seconds', 60)
+    monkeypatch.setattr(app, 'get_poll_interval', lambda attempt, deadline: 20)
+    event = get_event()
+
+    # Polled at 0, 20, 40 and 60 Seconds, the Heartbeat is Due After the Poll at 60 Seconds
+    ssm.add_response('send_command', {'Command': {'CommandId': command_id}})
+    for _ in range(4):
+        ssm.add_response('get_command_invocation', {'Status': 'InProgress'})
+    autoscaling.add_response('record_lifecycle_action_heartbeat', {}, get_lifecycle_params(event))
+    ssm.add_response('get_command_invocation', {'Status': 'Success', 'StandardOutputContent': ''})
+    autoscaling.add_response('complete_lifecycle_action', {}, dict(get_lifecycle_params(event), LifecycleActionResult='CONTINUE'))
+
+    app.lambda_handler(event, Context(clock, 900))
+    assert clock.now == 1000.0 + 80
+
+def test_catalog_keeps_the_original_commands():
+    assert app.get_steps(get_event(origin='WarmPool', destination='AutoScalingGroup')) == ['install', 'start', 'configure']
+    assert app.get_command(app.get_steps(get_event())) == '\n'.join([
+        'set -e',
+        'sudo yum -y install httpd',
+        'sudo service httpd start',
+        'sleep 60'
+    ])
+
+# The Steps Completed When the Instance Was Hydrated are Skipped When it Leaves the Warm Pool
+def test_warm_pool_instance_only_runs_start(monkeypatch, tmp_path, clock, ssm, autoscaling):
+    monkeypatch.setattr(app, 'ledger_store', app.FileLedgerStore(str(tmp_path)))
+
+    for origin, destination, command in [
+        ('EC2', 'WarmPool', app.get_command(['install', 'start', 'configure'])),
+        ('WarmPool', 'AutoScalingGroup', app.get_command(['start']))
+    ]:
+        event = get_event(origin=origin, destination=destination)
+        ssm.add_response('send_command', {'Command': {'CommandId': command_id}}, {
+            'InstanceIds': [event['detail']['EC2InstanceId']],
+            'DocumentName': 'AWS-RunShellScript',
+            'Parameters': {'commands': [command]}
+        })
+        ssm.add_response('get_command_invocation', {'Status': 'Success', 'StandardOutputContent': ''})
+        autoscaling.add_response('complete_lifecycle_action', {}, dict(get_lifecycle_params(event), LifecycleActionResult='CONTINUE'))
+
+        app.lambda_handler(event, Context(clock, 900))
+
+    assert app.get_steps(get_event(origin='WarmPool', destination='AutoScalingGroup')) == ['start']
+
+@pytest.mark.parametrize('platform,shell', [('linux', 'sh'), ('windows', 'powershell')])
+def test_independent_steps_run_in_one_wave(monkeypatch, catalog, platform, shell):
+    monkeypatch.setattr(app, 'platform', platform)
+    assert app.get_waves(['first', 'second']) == [['first', 'second']]
+
+    script = app.get_command(['first', 'second'])
+    if shell == 'powershell':
+        # Each Job Checks the Exit Code of its Native Commands
+        assert script.count('Start-Job') == 2
+        assert script.count('if ($LASTEXITCODE) { throw') == 2
+        if shutil.which('pwsh') is None:
+            pytest.skip('pwsh is not installed')
+
+    result = run_script(shell, script)
+    assert result.returncode == 0
+    assert sorted(result.stdout.split()) == ['first', 'second']
+
+@pytest.mark.parametrize('platform,shell', [('linux', 'sh'), ('windows', 'powershell')])
+def test_failing_step_fails_its_wave(monkeypatch, catalog, platform, shell):
+    monkeypatch.setattr(app, 'platform', platform)
+    assert app.get_waves(['first', 'failing']) == [['first', 'failing']]
+
+    script = app.get_command(['first', 'failing'])
+    if shell == 'powershell':
+        assert 'if ($jobs | Where-Object { $_.State -eq "Failed" }) { exit 1 }' in script
+        if shutil.which('pwsh') is None:
+            pytest.skip('pwsh is not installed')
+
+    assert run_script(shell, script).returncode != 0
+
+def get_status_event(instance_id='i-0123456789abcdef0', status='Failed'):
+    return {'detail': {'command-id': command_id, 'instance-id': instance_id, 'status': status}}
+
+def test_status_of_unknown_command_is_ignored_without_waiting(monkeypatch, tmp_path, clock, autoscaling):
+    monkeypatch.setattr(app, 'state_store', app.FileStateStore(str(tmp_path)))
+
+    app.command_status_handler(get_status_event(), None)
+    assert clock.now == 1000.0
+
+def test_status_waits_for_a_command_being_dispatched(monkeypatch, tmp_path, clock, autoscaling):
+    monkeypatch.setattr(app, 'state_store', app.FileStateStore(str(tmp_path)))
+    event = get_event()
+    state = {field: event['detail'][field] for field in app.lifecycle_fields}
+    app.state_store.put(app.dispatching_command_id, event['detail']['EC2InstanceId'], state)
+
+    # The State of the Command is Stored While the Handler Sleeps
+    def sleep(seconds):
+        clock.now += seconds
+        app.state_store.put(command_id, event['detail']['EC2InstanceId'], dict(state, Steps={}))
+    monkeypatch.setattr(clock, 'sleep', sleep)
+    autoscaling.add_response('complete_lifecycle_action', {}, dict(get_lifecycle_params(event), LifecycleActionResult='ABANDON'))
+
+    app.command_status_handler(get_status_event(), None)
+    assert clock.now == 1001.0
+    assert app.state_store.get(command_id, event['detail']['EC2InstanceId']) is None
+
+def test_first_poll_interval_is_the_initial_interval(monkeypatch):
+    monkeypatch.setattr(app.random, 'uniform', lambda low, high: high)
+    assert app.get_poll_interval(1, None) == app.poll_initial_interval_seconds
+    assert app.get_poll_interval(2, None) == app.poll_initial_interval_seconds * 2
+
+def test_send_command_waits_for_registration(clock, ssm):
+    # Ten Attempts Spaced at Least 10, 15, ... 50 Seconds Apart
+    for _ in range(app.send_command_attempts - 1):
+        ssm.add_client_error('send_command', 'InvalidInstanceId')
+    ssm.add_response('send_command', {'Command': {'CommandId': command_id}})
+
+    assert app.send_command(['i-0123456789abcdef0'], 'echo') == command_id
+    assert clock.now - 1000.0 >= 270
@@ -0,0 +1,340 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+# Defaults
+default_accounts = 10
+default_regions = 17
+default_launch_configurations = 20
+default_auto_scaling_groups = 10
+default_instances = 2
+default_page_size = 50
+default_latency_ms = 50
+default_throttle_rate = 0.0
+default_workers = [1, 8, 32]
+default_seed = 42
+
+# Regions Returned by the Simulated Organization, Synthetic Names are Used Beyond These
+known_regions = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1', 'sa-east-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1', 'ap-south-1',
+    'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2'
+]
+
+# Access Keys Handed Out by the Simulated AssumeRole Embed the Account ID
+role_access_key_prefix = 'ASIASIM'
+management_access_key = 'AKIASIMMANAGEMENT000'
+management_account_id = '100000000000'
+
+# Arguments
+parser = argparse.ArgumentParser(description='Benchmark the Launch Configuration inventory against a simulated organization.')
+parser.add_argument("-a",  "--accounts",      help="Numbers of accounts in the simulated organization, each runs as a separate scan.", type=int, nargs='+', default=[default_accounts])
+parser.add_argument("-r",  "--regions",       help="Number of regions enabled in each account.", type=int, default=default_regions)
+parser.add_argument("-l",  "--launch_configurations", help="Number of launch configurations in each account and region.", type=int, default=default_launch_configurations)
+parser.add_argument("-g",  "--auto_scaling_groups",   help="Number of Auto Scaling groups in each account and region.", type=int, default=default_auto_scaling_groups)
+parser.add_argument("-n",  "--instances",     help="Number of instances in each Auto Scaling group.", type=int, default=default_instances)
+parser.add_argument("-ps", "--page_size",     help="Number of items returned per page by paginated APIs.", type=int, default=default_page_size)
+parser.add_argument("-la", "--latency",       help="Simulated latency of each API call in milliseconds.", type=float, default=default_latency_ms)
+parser.add_argument("-tr", "--throttle_rate", help="Fraction of API calls that are throttled, between 0 and 1.", type=float, default=default_throttle_rate)
+parser.add_argument("-w",  "--workers",       help="Worker counts to benchmark, each runs as a separate scan.", type=int, nargs='+', default=default_workers)
+parser.add_argument("-m",  "--mode",          help="Inventory mode to benchmark.", choices=['all', 'in_use', 'joined'], default='all')
+parser.add_argument("-s",  "--seed",          help="Seed for throttle injection, the same calls are throttled on every run and with any number of workers.", type=int, default=default_seed)
+parser.add_argument("-f",  "--file",          help="Saves the benchmark results to a JSON file of your choice.")
+parser.add_argument("-mg", "--max_memory_growth", help="Fails when peak memory of the largest organization exceeds the smallest by more than this factor, for the same worker count.", type=float)
+parser.add_argument("--run_scan",             help=argparse.SUPPRESS)
+
+# Logging, Only Configured When Run as a Script so Importing the Simulation Leaves the Root Logger Alone
+logger = logging.getLogger()
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+
+def configure_logging():
+    logger.setLevel(logging.INFO)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+
+# Answers API Calls on Behalf of a Simulated Organization, Without Sending Any Requests
+class SimulatedOrganization:
+
+    def __init__(self, config):
+        self.config = config
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.accounts = [str(int(management_account_id) + index) for index in range(config['accounts'])]
+        self.regions = (known_regions + ['sim-region-{}'.format(index) for index in range(config['regions'])])[:config['regions']]
+        self.credential_minutes = config.get('credential_minutes', 60)
+        self.issued = {}
+
+    # Replaced by Tests to Move the Clock Forward
+    def now(self):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    # Registered on a botocore Session, Clients Created From it Inherit the Handlers
+    def register(self, session):
+        session.events.register('before-parameter-build', self.capture_params)
+        session.events.register('before-call', self.respond)
+
+    def capture_params(self, params, context, **kwargs):
+        context['simulated_params'] = dict(params)
+
+    # Throttles a Call Based on a Hash of the Seed, the Call and How Many Times it Was Made Before, Calls for the
+    # Same Account, Region and Page Are Made One After the Other, so the Same Calls Are Throttled Whatever the Thread Timing
+    def is_throttled(self, account_id, region, operation_name, params):
+        key = (account_id, region, operation_name, params.get('NextToken'))
+        with self.lock:
+            count = self.calls[key] = self.calls.get(key, 0) + 1
+
+        digest = hashlib.sha256('{}:{}:{}'.format(self.config['seed'], key, count).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64 < self.config['throttle_rate']
+
+    def respond(self, model, request_signer, context, **kwargs):
+        time.sleep(self.config['latency'] / 1000.0)
+
+        access_key = request_signer._credentials.access_key
+        account_id = access_key[len(role_access_key_prefix):][:12] if access_key.startswith(role_access_key_prefix) else management_account_id
+        params = context.get('simulated_params', {})
+
+        if model.name != 'AssumeRole' and self.is_throttled(account_id, context['client_region'], model.name, params):
+            return AWSResponse(None, 400, {}, None), {
+                'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                'ResponseMetadata': {'HTTPStatusCode': 400}
+            }
+
+        # Calls Signed With Expired Assumed Role Credentials are Rejected Like STS Would
+        with self.lock:
+            expiration = self.issued.get(access_key)
+        if expiration is not None and expiration <= self.now():
+            return AWSResponse(None, 400, {}, None), {
+                'Error': {'Code': 'ExpiredToken', 'Message': 'The security token included in the request is expired'},
+                'ResponseMetadata': {'HTTPStatusCode': 400}
+            }
+
+        operation = getattr(self, model.name)
+
+        response = operation(account_id, context['client_region'], params)
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200, 'HTTPHeaders': {'content-length': str(len(json.dumps(response, default=str)))}}
+        return AWSResponse(None, 200, {}, None), response
+
+    # Returns One Page of Items, Using the Item Offset as the NextToken
+    def page(self, key, items, params):
+        start = int(params.get('NextToken', 0))
+        end = start + self.config['page_size']
+        response = {key: items[start:end]}
+        if end < len(items):
+            response['NextToken'] = str(end)
+        return response
+
+    def AssumeRole(self, account_id, region, params):
+        role_account_id = params['RoleArn'].split(':')[4]
+        expiration = self.now() + datetime.timedelta(minutes=self.credential_minutes)
+
+        # Each Role Session Gets its Own Access Key so its Expiration Can be Checked
+        with self.lock:
+            access_key = '{}{}{:08d}'.format(role_access_key_prefix, role_account_id, len(self.issued))
+            self.issued[access_key] = expiration
+
+        return {
+            'Credentials': {
+                'AccessKeyId': access_key,
+                'SecretAccessKey': 'simulated',
+                'SessionToken': 'simulated',
+                'Expiration': expiration
+            }
+        }
+
+    def GetCallerIdentity(self, account_id, region, params):
+        return {'Account': account_id}
+
+    def ListAccounts(self, account_id, region, params):
+        return self.page('Accounts', [{'Id': account, 'Status': 'ACTIVE'} for account in self.accounts], params)
+
+    def DescribeRegions(self, account_id, region, params):
+        return {'Regions': [{'RegionName': name} for name in self.regions]}
+
+    def DescribeLaunchConfigurations(self, account_id, region, params):
+        launch_configurations = [
+            {'LaunchConfigurationName': 'lc-{}-{}'.format(region, index)}
+            for index in range(self.config['launch_configurations'])
+        ]
+        return self.page('LaunchConfigurations', launch_configurations, params)
+
+    def DescribeAutoScalingGroups(self, account_id, region, params):
+        auto_scaling_groups = []
+        for index in range(self.config['auto_scaling_groups']):
+            launch_configuration = 'lc-{}-{}'.format(region, index % max(1, self.config['launch_configurations']))
+            auto_scaling_groups.append({
+                'AutoScalingGroupName': 'asg-{}-{}'.format(region, index),
+                'LaunchConfigurationName': launch_configuration,
+                'Instances': [
+                    {'InstanceId': 'i-{:08x}{:09x}'.format(index, instance), 'LaunchConfigurationName': launch_configuration, 'LifecycleState': 'InService'}
+                    for instance in range(self.config['instances'])
+                ]
+            })
+        return self.page('AutoScalingGroups', auto_scaling_groups, params)
+
+# Runs a Single Scan Against the Simulated Organization and Saves its Measurements
+def run_scan(config_file):
+    with open(config_file) as fd:
+        config = json.load(fd)
+
+    # Keep Local AWS Configuration Out of the Benchmark
+    os.environ['AWS_ACCESS_KEY_ID'] = management_access_key
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'simulated'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+    os.environ['AWS_CONFIG_FILE'] = os.devnull
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = os.devnull
+    os.environ.pop('AWS_PROFILE', None)
+    os.environ.pop('AWS_SESSION_TOKEN', None)
+
+    import boto3
+    boto3.setup_default_session()
+    organization = SimulatedOrganization(config)
+    organization.register(boto3.DEFAULT_SESSION)
+
+    scan_args = [
+        '-o', '-or', 'SimulatedRole',
+        '-r', 'arn:aws:iam::{}:role/SimulatedRole'.format(management_account_id),
+        '-w', str(config['workers']),
+        '-f', os.path.join(config['directory'], 'inventory.csv')
+    ]
+    if config['mode'] == 'in_use':
+        scan_args.append('-i')
+    if config['mode'] == 'joined':
+        scan_args.append('-j')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import inventory
+
+    start = time.perf_counter()
+    writer = inventory.main(scan_args)
+    wall_clock = time.perf_counter() - start
+
+    calls = sum(stats['calls'] for stats in inventory.api_stats.values())
+    throttles = sum(stats['throttles'] for stats in inventory.api_stats.values())
+
+    # ru_maxrss is Reported in Kilobytes on Linux and Bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss = peak_rss * 1024
+
+    result = {
+        'accounts'       : config['accounts'],
+        'workers'        : config['workers'],
+        'records'        : writer.launch_configurations,
+        'wall_clock'     : wall_clock,
+        'records_per_sec': writer.launch_configurations / wall_clock if wall_clock > 0 else 0,
+        'api_calls'      : calls,
+        'throttles'      : throttles,
+        'peak_rss_mb'    : peak_rss / (1024 * 1024)
+    }
+
+    with open(os.path.join(config['directory'], 'result.json'), 'w') as fd:
+        json.dump(result, fd)
+
+    return
+
+# Runs Each Scan in its Own Process so Module State and Peak Memory are Measured in Isolation
+def benchmark(args):
+    results = []
+
+    for accounts, workers in [(accounts, workers) for accounts in args.accounts for workers in args.workers]:
+        with tempfile.TemporaryDirectory() as directory:
+            config = {
+                'accounts'              : accounts,
+                'regions'               : args.regions,
+                'launch_configurations' : args.launch_configurations,
+                'auto_scaling_groups'   : args.auto_scaling_groups,
+                'instances'             : args.instances,
+                'page_size'             : args.page_size,
+                'latency'               : args.latency,
+                'throttle_rate'         : args.throttle_rate,
+                'mode'                  : args.mode,
+                'seed'                  : args.seed,
+                'workers'               : workers,
+                'directory'             : directory
+            }
+            config_file = os.path.join(directory, 'config.json')
+            with open(config_file, 'w') as fd:
+                json.dump(config, fd)
+
+            logger.info('Scanning {} accounts x {} regions x {} launch configurations with {} workers.'.format(accounts, args.regions, args.launch_configurations, workers))
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--run_scan', config_file], check=True, stdout=subprocess.DEVNULL)
+
+            with open(os.path.join(directory, 'result.json')) as fd:
+                result = json.load(fd)
+
+        logger.info('accounts={} workers={} records={} wall_clock={:.2f}s records/sec={:.1f} api_calls={} throttles={} peak_rss={:.1f}MB'.format(
+            result['accounts'],
+            result['workers'],
+            result['records'],
+            result['wall_clock'],
+            result['records_per_sec'],
+            result['api_calls'],
+            result['throttles'],
+            result['peak_rss_mb']
+            ))
+        results.append(result)
+
+    if args.file:
+        logger.info('Saving benchmark results to file: {}'.format(args.file))
+        with open(args.file, 'w') as fd:
+            json.dump({'parameters': {key: value for key, value in vars(args).items() if key not in ['file', 'run_scan']}, 'results': results}, fd, indent=2)
+
+    return results
+
+# Gets How Much Peak Memory Grows From the Smallest to the Largest Organization, for Each Worker Count
+def get_memory_growth(results):
+    growth = {}
+    for workers in set(result['workers'] for result in results):
+        scans = sorted((result for result in results if result['workers'] == workers), key=lambda result: result['accounts'])
+        growth[workers] = scans[-1]['peak_rss_mb'] / scans[0]['peak_rss_mb']
+    return growth
+
+def main():
+    args = parser.parse_args()
+
+    # Scans Log Through inventory.main(), Which Configures Logging Itself
+    if args.run_scan:
+        run_scan(args.run_scan)
+    else:
+        configure_logging()
+        results = benchmark(args)
+
+        # Rows and Clients of Written Accounts are Released, so Memory Should Not Follow the Number of Accounts
+        if len(args.accounts) > 1:
+            for workers, growth in sorted(get_memory_growth(results).items()):
+                logger.info('workers={} peak memory grew {:.2f}x from {} to {} accounts'.format(workers, growth, min(args.accounts), max(args.accounts)))
+                if args.max_memory_growth and growth > args.max_memory_growth:
+                    logger.error('Peak memory grew more than {:.2f}x with {} workers'.format(args.max_memory_growth, workers))
+                    sys.exit(1)
+
+if __name__ == "__main__":
+    main()
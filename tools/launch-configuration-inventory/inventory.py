@@ -15,83 +15,382 @@
 
 import boto3
 import logging
+import os
 import sys
 import csv
+import gzip
+import json
+import sqlite3
 import argparse
-
-from botocore.exceptions import ClientError
+import bisect
+import hashlib
+import threading
+import time
+import datetime
+import random
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+
+# Parquet Output is Optional and Requires pyarrow
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # Defaults 
-default_output_file = "inventory.csv"
+default_output_format = 'csv'
+default_output_files = {
+    'csv'     : "inventory.csv",
+    'jsonl'   : "inventory.jsonl.gz",
+    'parquet' : "inventory.parquet"
+}
+default_parquet_row_group_size = 100000
 default_aws_profile = 'default'
+default_workers = 1
+default_credential_refresh_minutes = 10
+default_diff_file = "inventory-diff.csv"
+default_snapshot_max_age_minutes = 1440
+default_max_rate = 10
+default_max_retries = 8
+default_top = 5
+default_accounts_per_worker = 4
+
+# Parses a Shard in the Form I/N
+def parse_shard(value):
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be in the form I/N, for example 0/4')
+
+    if count < 1 or index < 0 or index >= count:
+        raise argparse.ArgumentTypeError('shard index must be between 0 and N-1')
+
+    return (index, count)
 
 # Arguments
 parser = argparse.ArgumentParser(description='Generate an inventory of Launch Configurations.')
-parser.add_argument("-f",  "--file",          help="Directs the output to a file of your choice", default=default_output_file)
+parser.add_argument("-f",  "--file",          help="Directs the output to a file of your choice")
+parser.add_argument("-fo", "--format",        help="Output format, csv writes one row per account and region, jsonl (gzip) and parquet write one row per launch configuration. Defaults to csv.", choices=sorted(default_output_files), default=default_output_format)
 parser.add_argument("-o",  "--org",           help="Scan all accounts in current organization.", action='store_true')
 parser.add_argument("-p",  "--profile",       help='Use a specific AWS config profile, defaults to default profile.')
 parser.add_argument("-or", "--org_role_name", help="Name of role that will be assumed to make API calls in Org accounts, required for Org.")
 parser.add_argument("-r",  "--role_arn",      help="Arn of role that will be assumed to make API calls instead of profile credentials.")
 parser.add_argument("-i",  "--in_use",        help="Inventories only the launch configurations that are currently in-use.", action='store_true')
+parser.add_argument("-j",  "--joined",        help="Inventories all launch configurations with the Auto Scaling groups and instances using them.", action='store_true')
+parser.add_argument("-t",  "--top",           help="Number of slowest accounts and regions to include in the summary, defaults to 5.", type=int, default=default_top)
+parser.add_argument("-w",  "--workers",       help="Number of concurrent workers used to scan accounts and regions, defaults to 1 (serial).", type=int, default=default_workers)
+parser.add_argument("-ac", "--account_concurrency", help="Maximum number of regions scanned concurrently in a single account.", type=int)
+parser.add_argument("-rc", "--region_concurrency",  help="Maximum number of accounts scanned concurrently in a single region.", type=int)
+parser.add_argument("-re", "--resume",        help="Resumes a previous scan, skipping accounts and regions already saved to the output file.", action='store_true')
+parser.add_argument("-s",  "--snapshot",      help="SQLite file used to store a snapshot of the inventory and report changes since the last scan.")
+parser.add_argument("-d",  "--diff_file",     help="Directs the report of changes since the last snapshot to a file of your choice.", default=default_diff_file)
+parser.add_argument("-in", "--incremental",   help="Only rescans accounts and regions whose snapshot is stale or changed in the last scan, requires --snapshot.", action='store_true')
+parser.add_argument("-mr", "--max_rate",      help="Maximum API calls per second for each account, region and API, defaults to 10. Lowered automatically when throttled.", type=float, default=default_max_rate)
+parser.add_argument("-ma", "--max_age",       help="Minutes after which a snapshot of an account and region is stale, defaults to 1440.", type=int, default=default_snapshot_max_age_minutes)
+
+parser.add_argument("-sh", "--shard",         help="Only scans the accounts in shard I of N (0 <= I < N), using a stable hash of the account ID, for example 0/4.", type=parse_shard)
 
 parser.set_defaults(org=False)
 parser.set_defaults(in_use=False)
-args = parser.parse_args()
+parser.set_defaults(joined=False)
+parser.set_defaults(resume=False)
+parser.set_defaults(incremental=False)
 
-if args.org and (args.org_role_name is None):
-    parser.error("--org requires --org_role_name")
+# Options of the Scan, Set by configure()
+args = None
 
-# Logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# Logging, Configured by main() so Importing This Module Does Not Change the Root Logger
+logger = logging.getLogger(__name__)
 handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
-logger.addHandler(handler)
 
-# Get and Return Credentials for Organization Role
-def get_credentials_for_role(role_arn, credentials):
+def configure_logging():
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    if handler not in root_logger.handlers:
+        root_logger.addHandler(handler)
+
+# Validates Options and Fills in Defaults That Depend on Other Options, Returns an Error Message if Invalid
+def check_args(options):
+
+    if options.org and (options.org_role_name is None):
+        return "--org requires --org_role_name"
+
+    # Shards Write to Their Own File by Default so They Can Share a Directory
+    if options.file is None and options.shard is not None:
+        name, extension = default_output_files[options.format].split('.', 1)
+        options.file = '{}-shard-{}-of-{}.{}'.format(name, options.shard[0], options.shard[1], extension)
+
+    if options.file is None:
+        options.file = default_output_files[options.format]
+
+    if options.format == 'parquet' and pyarrow is None:
+        return "--format parquet requires pyarrow, install it with: pip install pyarrow"
+
+    if options.format == 'parquet' and options.resume:
+        return "--resume is not supported with --format parquet"
+
+    if options.in_use and options.joined:
+        return "--in_use and --joined cannot be used together"
+
+    if options.workers < 1:
+        return "--workers must be at least 1"
+
+    if options.max_rate <= 0:
+        return "--max_rate must be greater than 0"
+
+    if options.incremental and (options.snapshot is None):
+        return "--incremental requires --snapshot"
+
+    return None
+
+# Parses and Validates Command Line Arguments
+def parse_args(argv=None):
+    options = parser.parse_args(argv)
+
+    error = check_args(options)
+    if error:
+        parser.error(error)
+
+    return options
+
+# Limits the Number of Concurrent Tasks per Key (Account or Region)
+class KeyedSemaphore:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get(self, key):
+        if self.limit is None:
+            return None
+
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[key]
+
+    def acquire(self, key):
+        semaphore = self.get(key)
+        if semaphore is not None:
+            semaphore.acquire()
+
+    def release(self, key):
+        semaphore = self.get(key)
+        if semaphore is not None:
+            semaphore.release()
+
+account_limiter = None
+region_limiter = None
+
+# Assumed Role Credential Providers Keyed by Role ARN
+credential_cache = {}
+credential_cache_lock = threading.Lock()
+
+# Clients Keyed by (Account, Service, Region), Sized so Every Worker Can Keep a Connection Alive
+client_cache = {}
+client_cache_lock = threading.Lock()
+# Throttled Calls are Retried by call_api so the Rate Limiters See Them, Instead of Inside Botocore
+client_config = None
+
+cache_stats = {'credentials_reused': 0, 'credentials_assumed': 0, 'clients_reused': 0, 'clients_created': 0}
+
+# Errors Returned by AWS APIs When Calls are Throttled or Should be Retried
+throttling_error_codes = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException', 'TooManyRequestsException']
+retryable_error_codes = ['InternalError', 'InternalFailure', 'ServiceUnavailable']
+
+# Token Bucket That Halves its Rate When Throttled and Slowly Increases it Again on Success (AIMD)
+class AdaptiveRateLimiter:
+
+    MIN_RATE = 0.5
+    RATE_INCREASE = 0.1
+    RATE_DECREASE = 0.5
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = max(1.0, max_rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-    logger.info('Attempting to assume role: {}'.format(role_arn))
+    # Tokens Can Go Negative, Which Reserves a Slot in the Future That the Caller Waits For
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
 
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.RATE_INCREASE)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.MIN_RATE, self.rate * self.RATE_DECREASE)
+            self.tokens = min(self.tokens, 0)
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# Upper Bounds in Seconds of the Latency Histogram Buckets, the Last Bucket Holds Everything Slower
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# API Counters and Latencies Keyed by (Account, Region, API)
+api_stats = {}
+api_stats_lock = threading.Lock()
+
+# Latencies Recorded per Task, Used to Size the Worker Pool, and per (Task, Account, Region) for the Run Report
+timings = {}
+task_stats = {}
+timings_lock = threading.Lock()
+
+# Creates an Empty Latency Histogram
+def new_histogram():
+    return {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(latency_buckets) + 1)}
+
+# Adds a Latency to a Histogram
+def observe(histogram, seconds):
+    histogram['count'] += 1
+    histogram['sum'] += seconds
+    histogram['max'] = max(histogram['max'], seconds)
+    histogram['buckets'][bisect.bisect_left(latency_buckets, seconds)] += 1
+
+# Sets the Options of the Scan and Resets Limiters, Caches and Counters Left by a Previous Scan
+def configure(options):
+    global args, account_limiter, region_limiter, client_config
+
+    args = options
+    account_limiter = KeyedSemaphore(options.account_concurrency)
+    region_limiter = KeyedSemaphore(options.region_concurrency)
+    client_config = Config(max_pool_connections=max(10, options.workers), tcp_keepalive=True, retries={'mode': 'standard', 'total_max_attempts': 1})
+
+    for state in [credential_cache, client_cache, rate_limiters, api_stats, timings, task_stats]:
+        state.clear()
+    for counter in cache_stats:
+        cache_stats[counter] = 0
+
+    return
+
+# Runs a Function for an Account and Region and Records How Long it Took
+def timed(task, account_id, region, function, *call_args):
+    start = time.perf_counter()
     try:
-        sts = None
-        if credentials: 
-            sts = boto3.client('sts', **credentials)
-        else:
-            sts = boto3.client('sts')
+        return function(*call_args)
+    finally:
+        elapsed = time.perf_counter() - start
+        with timings_lock:
+            timings.setdefault(task, []).append(elapsed)
+            observe(task_stats.setdefault((task, account_id, region), new_histogram()), elapsed)
+
+# Gets a Cached Client, Creating a New One if None Exists or the Credentials Have Been Refreshed
+# Credentials are a Provider, Reading Them Refreshes Them First if They are Close to Expiring
+def get_client(account_id, service, region, credentials):
+    key = (account_id, service, region)
+    frozen = credentials.get_frozen_credentials() if credentials else None
+    access_key = frozen.access_key if frozen else None
+
+    # Client Creation Uses the Default Session, Which is Not Thread Safe
+    with client_cache_lock:
+        cached = client_cache.get(key)
+        if cached is not None and cached[0] == access_key:
+            cache_stats['clients_reused'] += 1
+            return cached[1]
+
+        keys = {}
+        if frozen:
+            keys = {'aws_access_key_id': frozen.access_key, 'aws_secret_access_key': frozen.secret_key, 'aws_session_token': frozen.token}
+        client = boto3.client(service, region_name=region, config=client_config, **keys)
+        client_cache[key] = (access_key, client)
+        cache_stats['clients_created'] += 1
+
+    return client
+
+# Drops the Clients and Credentials of an Account Once its Rows are Written, so Memory Does Not Grow With the Organization
+def release_account(account_id, role_arn):
+    with client_cache_lock:
+        for key in [key for key in client_cache if key[0] == account_id]:
+            del client_cache[key]
+
+    if role_arn:
+        with credential_cache_lock:
+            credential_cache.pop(role_arn, None)
 
-        response = sts.assume_role(
+    return
+
+# Get and Return a Credential Provider for Organization Role
+# The Role is Assumed With the Source Provider, Which is Refreshed Too, so Chained Roles Never Outlive Their Parent
+def get_credentials_for_role(role_arn, credentials):
+
+    # Reuse the Provider of a Role Already Assumed
+    with credential_cache_lock:
+        cached = credential_cache.get(role_arn)
+        if cached is not None:
+            cache_stats['credentials_reused'] += 1
+            return cached
+
+    def assume_role():
+        logger.info('Attempting to assume role: {}'.format(role_arn))
+
+        sts = get_client(None, 'sts', None, credentials)
+
+        response = call_api(sts.assume_role, None,
                     RoleArn=role_arn,
                     RoleSessionName="RoleAssume"
                 )
 
-        # Get Credentials From Session
-        credentials = {
-            'aws_access_key_id'     : response["Credentials"]["AccessKeyId"],
-            'aws_secret_access_key' : response["Credentials"]["SecretAccessKey"],
-            'aws_session_token'     : response["Credentials"]["SessionToken"],
+        with credential_cache_lock:
+            cache_stats['credentials_assumed'] += 1
+
+        return {
+            'access_key'  : response["Credentials"]["AccessKeyId"],
+            'secret_key'  : response["Credentials"]["SecretAccessKey"],
+            'token'       : response["Credentials"]["SessionToken"],
+            'expiry_time' : response["Credentials"]["Expiration"].isoformat()
         }
 
-        return credentials
+    try:
+        # Refreshed Once Within the Refresh Margin of Expiring, and Before Any Call Once Half of it is Left
+        role_credentials = RefreshableCredentials.create_from_metadata(
+            assume_role(),
+            assume_role,
+            'sts-assume-role',
+            advisory_timeout=default_credential_refresh_minutes * 60,
+            mandatory_timeout=default_credential_refresh_minutes * 60 // 2
+        )
+
+        with credential_cache_lock:
+            credential_cache[role_arn] = role_credentials
+
+        return role_credentials
 
     except Exception as e:
         message = 'Could not assume role: {} : {}'.format(role_arn, e)
         logger.error(message)
         return None
 
-# Get and Return Credentials for Provided AWS Profile
+# Get and Return the Credential Provider for Provided AWS Profile
 def get_credentials_for_profile(profile_name):
     logger.info('Attempting to get credentials for profile: {}'.format(profile_name))
 
     try:
         session = boto3.Session(profile_name=profile_name)
-        session_credentials = session.get_credentials() 
-        credentials = {
-            'aws_access_key_id'     : session_credentials.access_key,
-            'aws_secret_access_key' : session_credentials.secret_key
-        }
+        credentials = session.get_credentials()
+        if credentials is None:
+            raise ValueError('No credentials found')
         return credentials
 
     except Exception as e:
@@ -99,20 +398,89 @@ def get_credentials_for_profile(profile_name):
         logger.error(message)
         return None
 
-# Paginates Responses from API Calls
-def paginate(method, **kwargs):
+# Gets the Rate Limiter for an Account, Region and API
+def get_rate_limiter(account_id, region, api):
+    key = (account_id, region, api)
+
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = AdaptiveRateLimiter(args.max_rate)
+        return rate_limiters[key]
+
+# Gets the Counters for an Account, Region and API
+def get_api_stats(account_id, region, api):
+    key = (account_id, region, api)
+
+    if key not in api_stats:
+        api_stats[key] = {'calls': 0, 'pages': 0, 'throttles': 0, 'retries': 0, 'bytes': 0, 'latency': new_histogram()}
+    return api_stats[key]
+
+# Increments a Counter for an Account, Region and API
+def count_api(account_id, region, api, counter, value=1):
+    with api_stats_lock:
+        get_api_stats(account_id, region, api)[counter] += value
+
+# Records the Latency of a Call and the Size of its Response
+def observe_api(account_id, region, api, seconds, response):
+    content_length = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('content-length', 0)
+
+    with api_stats_lock:
+        stats = get_api_stats(account_id, region, api)
+        stats['bytes'] += int(content_length)
+        observe(stats['latency'], seconds)
+
+# Calls an API Through its Rate Limiter, Retrying Throttled and Transient Errors with Backoff
+def call_api(method, account_id, **kwargs):
+    api = method.__name__
+    region = method.__self__.meta.region_name
+    limiter = get_rate_limiter(account_id, region, api)
+
+    attempt = 0
+    while True:
+        limiter.acquire()
+        count_api(account_id, region, api, 'calls')
+        start = time.perf_counter()
+
+        try:
+            response = method(**kwargs)
+            limiter.on_success()
+            observe_api(account_id, region, api, time.perf_counter() - start, response)
+            return response
+
+        except (ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError) as e:
+            code = e.response['Error']['Code'] if isinstance(e, ClientError) else None
+            if code in throttling_error_codes:
+                count_api(account_id, region, api, 'throttles')
+                limiter.on_throttle()
+            elif isinstance(e, ClientError) and code not in retryable_error_codes:
+                raise
+
+            attempt = attempt + 1
+            if attempt > default_max_retries:
+                raise
+
+            count_api(account_id, region, api, 'retries')
+            logger.warning('Retrying {} for account {} after error, attempt #: {}: {}'.format(api, account_id, attempt, e))
+            time.sleep(random.uniform(0, min(20, 0.5 * 2 ** attempt)))
+
+# Paginates Responses from API Calls, a Retried Page Resumes From the Last Token Instead of the First Page
+# All APIs Paginated by This Script Use NextToken, Errors are Logged by the Caller
+def paginate(method, account_id=None, **kwargs):
     client = method.__self__
+    result_keys = client.get_paginator(method.__name__).result_keys
 
-    try:
-        paginator = client.get_paginator(method.__name__)
-        for page in paginator.paginate(**kwargs).result_key_iters():
-            for item in page:
+    while True:
+        page = call_api(method, account_id, **kwargs)
+        count_api(account_id, client.meta.region_name, method.__name__, 'pages')
+
+        for result_key in result_keys:
+            for item in result_key.search(page) or []:
                 yield item
 
-    except ClientError as e:
-        message = 'Error describing instances: {}'.format(e)
-        logger.error(message)
-        raise Exception(message)
+        if not page.get('NextToken'):
+            break
+
+        kwargs['NextToken'] = page['NextToken']
 
 # Gets a List of Accounts in Organization
 def get_organization_accounts(credentials):
@@ -120,7 +488,7 @@ def get_organization_accounts(credentials):
 
     accounts = []
     try:
-        organizations = boto3.client('organizations', **credentials)
+        organizations = get_client(None, 'organizations', None, credentials)
         response = paginate(organizations.list_accounts)
 
         for account in response:
@@ -128,30 +496,31 @@ def get_organization_accounts(credentials):
 
         return accounts
 
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         message = 'Error getting a list of accounts in the organization: {}'.format(e)
         logger.error(message)
 
     return accounts
 
-# Gets Regions Enabled for Account
+# Gets Regions Enabled for Account, None if They Could Not be Listed so the Account is Not Checkpointed
 def get_regions(account_id, credentials):
     logger.info('Getting a list of regions enabled for account {}.'.format(account_id))
 
     regions = []
     try:
-        ec2 = boto3.client('ec2', **credentials)
+        ec2 = get_client(account_id, 'ec2', None, credentials)
 
-        response = ec2.describe_regions(
+        response = call_api(ec2.describe_regions, account_id,
             AllRegions=False
             )
 
         for region in response['Regions']:
             regions.append(region['RegionName'])
 
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         message = 'Error getting list of regions: {}'.format(e)
         logger.error(message)
+        return None
     
     return regions 
 
@@ -161,9 +530,9 @@ def get_launch_configurations(account_id, region, credentials):
 
     launch_configurations = []
     try: 
-        autoscaling = boto3.client('autoscaling', region_name=region, **credentials)
+        autoscaling = get_client(account_id, 'autoscaling', region, credentials)
 
-        response = paginate(autoscaling.describe_launch_configurations)
+        response = paginate(autoscaling.describe_launch_configurations, account_id)
         
         for launch_configuration in response:
             launch_configurations.append(launch_configuration['LaunchConfigurationName'])
@@ -175,7 +544,7 @@ def get_launch_configurations(account_id, region, credentials):
             'launch_configuratons'  : launch_configurations
         }
 
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         message = 'Error getting list of launch configurations: {}'.format(e)
         logger.error(message)
 
@@ -187,9 +556,9 @@ def get_launch_configurations_in_use(account_id, region, credentials):
 
     launch_configurations = []
     try: 
-        autoscaling = boto3.client('autoscaling', region_name=region, **credentials)
+        autoscaling = get_client(account_id, 'autoscaling', region, credentials)
 
-        response = paginate(autoscaling.describe_auto_scaling_groups)
+        response = paginate(autoscaling.describe_auto_scaling_groups, account_id)
         
         for auto_scaling_group in response:
             if 'LaunchConfigurationName' in auto_scaling_group:
@@ -205,127 +574,711 @@ def get_launch_configurations_in_use(account_id, region, credentials):
             'launch_configuratons'  : launch_configurations
         }
 
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         message = 'Error getting list of launch configurations: {}'.format(e)
         logger.error(message)
 
     return {}
 
+# Gets All Launch Configurations in Account and Region With the Auto Scaling Groups and Instances Using Them
+def get_launch_configuration_usage(account_id, region, credentials):
+    logger.info('Getting Launch Configuration Usage for Region: {}'.format(region))
 
-# Writes an Inventory File of Launch Configurations
-def write_inventory_file(file, inventory):
-    logger.info('Saving results to output file: {}'.format(file))
+    try:
+        autoscaling = get_client(account_id, 'autoscaling', region, credentials)
+
+        # Build Hash Tables of Auto Scaling Groups and Instances Keyed by Launch Configuration
+        # Groups Already Include Their Instances, so DescribeAutoScalingInstances is Not Needed
+        # Only InService Instances are Counted, but an Instance in Any State Keeps its Launch Configuration in Use
+        auto_scaling_groups = {}
+        instances = {}
+        launch_configurations_with_instances = set()
+        for auto_scaling_group in paginate(autoscaling.describe_auto_scaling_groups, account_id):
+            if 'LaunchConfigurationName' in auto_scaling_group:
+                auto_scaling_groups.setdefault(auto_scaling_group['LaunchConfigurationName'], []).append(auto_scaling_group['AutoScalingGroupName'])
+
+            for instance in auto_scaling_group.get('Instances', []):
+                if 'LaunchConfigurationName' in instance:
+                    launch_configurations_with_instances.add(instance['LaunchConfigurationName'])
+                    if instance.get('LifecycleState') == 'InService':
+                        instances[instance['LaunchConfigurationName']] = instances.get(instance['LaunchConfigurationName'], 0) + 1
+
+        # Join Each Launch Configuration With its Groups and Instances
+        launch_configurations = []
+        for launch_configuration in paginate(autoscaling.describe_launch_configurations, account_id):
+            name = launch_configuration['LaunchConfigurationName']
+            launch_configurations.append({
+                'launch_configuration' : name,
+                'auto_scaling_groups'  : auto_scaling_groups.get(name, []),
+                'instances'            : instances.get(name, 0),
+                'unused'               : name not in auto_scaling_groups and name not in launch_configurations_with_instances
+                })
 
-    data_file = open(file, 'w', newline='')
-    csv_writer = csv.writer(data_file)
-    
-    count = 0
-    for data in inventory:
-        if count == 0:
-            header = data.keys()
-            csv_writer.writerow(header)
-            count += 1
-        csv_writer.writerow(data.values())
-    
-    data_file.close()
+        return {
+            'account_id'            : account_id,
+            'region'                : region,
+            'count'                 : len(launch_configurations),
+            'launch_configuratons'  : launch_configurations
+        }
+
+    except (ClientError, BotoCoreError) as e:
+        message = 'Error getting launch configuration usage: {}'.format(e)
+        logger.error(message)
+
+    return {}
+
+# Streams Inventory Rows to the Output File as Each Account and Region Completes
+class InventoryWriter:
+
+    # Region Recorded in the Checkpoint Journal Once Every Region of an Account is Saved
+    ACCOUNT_COMPLETE = '*'
+
+    def __init__(self, file, output_format, resume):
+        self.file = file
+        self.output_format = output_format
+        self.checkpoint_file = '{}.checkpoint'.format(file)
+        self.completed = set()
+        self.launch_configurations = 0
+        self.unused = 0
+        self.accounts = set()
+        self.regions = set()
+
+        mode = 'w'
+        if resume and os.path.exists(self.checkpoint_file):
+            logger.info('Resuming scan from checkpoint file: {}'.format(self.checkpoint_file))
+            saved_size = self.read_checkpoint()
+            mode = 'a'
+
+            # A Crash Can Leave Part of a Row or Gzip Member After the Last Saved Partition, Which Would Corrupt the File Once Appended to
+            if saved_size is not None and os.path.exists(file) and os.path.getsize(file) > saved_size:
+                logger.info('Dropping data written after the last saved partition of output file: {}'.format(file))
+                os.truncate(file, saved_size)
+
+        logger.info('Saving results to output file: {}'.format(file))
+
+        self.header_written = mode == 'a' and os.path.exists(file) and os.path.getsize(file) > 0
+        if output_format == 'parquet':
+            self.data_file = ParquetInventoryFile(file, inventory_kind())
+        elif output_format == 'jsonl':
+            self.data_file = open(file, mode + 'b')
+        else:
+            self.data_file = open(file, mode, newline='')
+            self.csv_writer = csv.writer(self.data_file)
+        self.checkpoint = open(self.checkpoint_file, mode, newline='')
+        self.checkpoint_writer = csv.writer(self.checkpoint)
+
+    # Loads the Partitions Saved by a Previous Run and Returns the Size of the Output File When the Last One Was Saved,
+    # None for Checkpoints Written Before Sizes Were Recorded. A Partly Written Last Line is Dropped
+    def read_checkpoint(self):
+        with open(self.checkpoint_file, newline='') as checkpoint_file:
+            lines = checkpoint_file.readlines()
+
+        if lines and not lines[-1].endswith('\n'):
+            lines.pop()
+            with open(self.checkpoint_file, 'w', newline='') as checkpoint_file:
+                checkpoint_file.writelines(lines)
+
+        saved_size = 0
+        for row in csv.reader(lines):
+            self.completed.add((row[0], row[1]))
+            if len(row) < 3:
+                saved_size = None
+            elif row[2] and saved_size is not None:
+                saved_size = int(row[2])
+
+        return saved_size
+
+    def is_complete(self, account_id, region=ACCOUNT_COMPLETE):
+        return (account_id, region) in self.completed
+
+    # Rows are Flushed Before They are Journaled so a Checkpointed Row is Always on Disk
+    def write(self, data):
+        if self.output_format == 'parquet':
+            self.data_file.write(get_inventory_records(data))
+        elif self.output_format == 'jsonl':
+            # Each Partition is a Complete Gzip Member, Concatenated Members Read as One File
+            lines = ''.join(json.dumps(record) + '\n' for record in get_inventory_records(data))
+            self.data_file.write(gzip.compress(lines.encode('utf-8')))
+        else:
+            if not self.header_written:
+                self.csv_writer.writerow(data.keys())
+                self.header_written = True
+            self.csv_writer.writerow(data.values())
+
+        self.data_file.flush()
+        saved_size = None if self.output_format == 'parquet' else os.fstat(self.data_file.fileno()).st_size
+        self.mark_complete(data['account_id'], data['region'], saved_size)
+
+        self.launch_configurations = self.launch_configurations + data['count']
+        self.unused = self.unused + sum(1 for item in data['launch_configuratons'] if isinstance(item, dict) and item.get('unused'))
+        self.accounts.add(data['account_id'])
+        self.regions.add(data['region'])
+
+        return
+
+    # The Size of the Output File is Recorded With Each Partition so a Resumed Scan Can Drop Anything Written After it
+    def mark_complete(self, account_id, region=ACCOUNT_COMPLETE, saved_size=None):
+        self.checkpoint_writer.writerow([account_id, region, '' if saved_size is None else saved_size])
+        self.checkpoint.flush()
+        self.completed.add((account_id, region))
+
+        return
+
+    def close(self):
+        self.data_file.close()
+        self.checkpoint.close()
+
+        return
+
+# Buffers Inventory Records and Writes Them to a Parquet File One Row Group at a Time
+# Rows are Only Readable Once the File is Closed, Which is Why Parquet Output Cannot be Resumed
+class ParquetInventoryFile:
+
+    def __init__(self, file, kind):
+        self.schema = get_parquet_schema(kind)
+        self.writer = pyarrow.parquet.ParquetWriter(file, self.schema)
+        self.records = []
+
+    def write(self, records):
+        self.records.extend(records)
+
+        if len(self.records) >= default_parquet_row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if self.records:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.records, schema=self.schema))
+            self.records = []
+
+    # Row Groups are Sized for Query Engines Rather Than Flushed per Account and Region
+    def flush(self):
+        return
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+
+# Gets the Parquet Schema for an Inventory Mode, Account and Region Columns are Dictionary Encoded
+def get_parquet_schema(kind):
+    fields = [
+        pyarrow.field('account_id', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        pyarrow.field('region', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        pyarrow.field('launch_configuration', pyarrow.string())
+    ]
+
+    if kind == 'in_use':
+        fields.append(pyarrow.field('auto_scaling_group', pyarrow.string()))
+
+    if kind == 'joined':
+        fields.append(pyarrow.field('auto_scaling_groups', pyarrow.list_(pyarrow.string())))
+        fields.append(pyarrow.field('instances', pyarrow.int64()))
+        fields.append(pyarrow.field('unused', pyarrow.bool_()))
+
+    return pyarrow.schema(fields)
+
+# Normalizes an Inventory Row Into One Record per Launch Configuration
+def get_inventory_records(data):
+    records = []
+
+    for item in data['launch_configuratons']:
+        record = {
+            'account_id' : data['account_id'],
+            'region'     : data['region']
+        }
+
+        if isinstance(item, dict):
+            record.update(item)
+        else:
+            record['launch_configuration'] = item
+
+        records.append(record)
+
+    return records
+
+# Stores the Launch Configurations Found in Each Account and Region to Detect Changes Between Scans
+class InventorySnapshot:
+
+    def __init__(self, file, max_age):
+        logger.info('Using snapshot file: {}'.format(file))
+
+        self.max_age = datetime.timedelta(minutes=max_age)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS partitions (
+                account_id  TEXT,
+                region      TEXT,
+                kind        TEXT,
+                scanned_at  TEXT,
+                changed     INTEGER,
+                row         TEXT,
+                PRIMARY KEY (account_id, region, kind)
+            );
+            CREATE TABLE IF NOT EXISTS launch_configurations (
+                account_id  TEXT,
+                region      TEXT,
+                kind        TEXT,
+                name        TEXT,
+                PRIMARY KEY (account_id, region, kind, name)
+            );
+        ''')
+
+    # A Partition is Fresh if it Was Scanned Recently and Did Not Change in That Scan
+    def is_fresh(self, account_id, region, kind):
+        with self.lock:
+            partition = self.connection.execute(
+                'SELECT scanned_at, changed FROM partitions WHERE account_id = ? AND region = ? AND kind = ?',
+                (account_id, region, kind)
+                ).fetchone()
+
+        if partition is None or partition[1]:
+            return False
+
+        scanned_at = datetime.datetime.fromisoformat(partition[0])
+        return datetime.datetime.now(datetime.timezone.utc) - scanned_at < self.max_age
+
+    # Gets the Inventory Row Saved by the Last Scan of a Partition
+    def load(self, account_id, region, kind):
+        with self.lock:
+            partition = self.connection.execute(
+                'SELECT row FROM partitions WHERE account_id = ? AND region = ? AND kind = ?',
+                (account_id, region, kind)
+                ).fetchone()
+
+        return json.loads(partition[0])
+
+    # Saves a Scanned Partition and Returns How it Changed Since the Last Snapshot
+    def record(self, data, kind):
+        account_id = data['account_id']
+        region = data['region']
+
+        with self.lock, self.connection:
+            known = self.connection.execute(
+                'SELECT 1 FROM partitions WHERE account_id = ? AND region = ? AND kind = ?',
+                (account_id, region, kind)
+                ).fetchone() is not None
+
+            changes = []
+            for listing, names in get_snapshot_listings(data, kind).items():
+                previous = set(name for (name,) in self.connection.execute(
+                    'SELECT name FROM launch_configurations WHERE account_id = ? AND region = ? AND kind = ?',
+                    (account_id, region, listing)
+                    ))
+
+                # Partitions Seen for the First Time Only Establish a Baseline
+                if known:
+                    added, removed = ('now_in_use', 'no_longer_in_use') if listing == 'in_use' else ('added', 'removed')
+                    changes.extend((added, name) for name in sorted(names - previous))
+                    changes.extend((removed, name) for name in sorted(previous - names))
+
+                self.connection.executemany(
+                    'DELETE FROM launch_configurations WHERE account_id = ? AND region = ? AND kind = ? AND name = ?',
+                    [(account_id, region, listing, name) for name in previous - names]
+                    )
+                self.connection.executemany(
+                    'INSERT INTO launch_configurations (account_id, region, kind, name) VALUES (?, ?, ?, ?)',
+                    [(account_id, region, listing, name) for name in names - previous]
+                    )
+
+            self.connection.execute(
+                'INSERT OR REPLACE INTO partitions (account_id, region, kind, scanned_at, changed, row) VALUES (?, ?, ?, ?, ?, ?)',
+                (account_id, region, kind, datetime.datetime.now(datetime.timezone.utc).isoformat(), len(changes) > 0, json.dumps(data))
+                )
+
+        return changes
+
+    def close(self):
+        self.connection.close()
+
+        return
+
+# Gets the Launch Configuration Name From an Item of Any Inventory Mode
+def get_launch_configuration_name(item):
+    if isinstance(item, dict):
+        return item['launch_configuration']
+    return item
+
+# Gets the Sets of Launch Configuration Names Tracked by the Snapshot for a Row
+# The Joined Mode Tracks Both Listings, so it Reports Added, Removed and Newly In-Use Launch Configurations
+def get_snapshot_listings(data, kind):
+    names = set(get_launch_configuration_name(item) for item in data['launch_configuratons'])
+
+    if kind == 'joined':
+        in_use = set(item['launch_configuration'] for item in data['launch_configuratons'] if item['auto_scaling_groups'])
+        return {'all': names, 'in_use': in_use}
+
+    return {kind: names}
+
+# Outputs Wall-Clock Time and Per-Task Latencies of the Scan
+def write_timings(wall_clock, workers):
+
+    logger.info('Scan completed in {:.2f} seconds using {} workers.'.format(wall_clock, workers))
+    logger.info('Assumed {} roles and reused cached credentials {} times, created {} clients and reused cached clients {} times.'.format(
+        cache_stats['credentials_assumed'],
+        cache_stats['credentials_reused'],
+        cache_stats['clients_created'],
+        cache_stats['clients_reused']
+        ))
+
+    # Aggregate API Counters Across Accounts and Regions
+    apis = {}
+    for (account_id, region, api), stats in api_stats.items():
+        totals = apis.setdefault(api, {'calls': 0, 'pages': 0, 'throttles': 0, 'retries': 0, 'bytes': 0})
+        for counter in totals:
+            totals[counter] += stats[counter]
+
+    for api, stats in sorted(apis.items()):
+        logger.info('{}: calls={} pages={} throttles={} retries={} bytes={} calls/sec={:.2f}'.format(
+            api,
+            stats['calls'],
+            stats['pages'],
+            stats['throttles'],
+            stats['retries'],
+            stats['bytes'],
+            stats['calls'] / wall_clock if wall_clock > 0 else 0
+            ))
+
+    for task, latencies in sorted(timings.items()):
+        latencies = sorted(latencies)
+        count = len(latencies)
+        logger.info('{}: count={} avg={:.3f}s p50={:.3f}s p95={:.3f}s max={:.3f}s'.format(
+            task,
+            count,
+            sum(latencies) / count,
+            latencies[int(0.50 * (count - 1))],
+            latencies[int(0.95 * (count - 1))],
+            latencies[-1]
+            ))
+
+    return
+
+# Gets the Accounts and the Account and Region Pairs That Took the Longest to Scan
+def get_slowest(top):
+    accounts = {}
+    regions = {}
+
+    for (task, account_id, region), histogram in task_stats.items():
+        accounts[account_id] = accounts.get(account_id, 0) + histogram['sum']
+        if region is not None:
+            regions[(account_id, region)] = regions.get((account_id, region), 0) + histogram['sum']
+
+    slowest_accounts = sorted(accounts.items(), key=lambda item: item[1], reverse=True)[:top]
+    slowest_regions = sorted(regions.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    return (
+        [{'account_id': account_id, 'seconds': seconds} for account_id, seconds in slowest_accounts],
+        [{'account_id': account_id, 'region': region, 'seconds': seconds} for (account_id, region), seconds in slowest_regions]
+        )
+
+# Writes a Machine-Readable Report of the Scan Next to the Output File
+def write_report(file, writer, wall_clock, workers):
+    logger.info('Saving run report to file: {}'.format(file))
+
+    slowest_accounts, slowest_regions = get_slowest(args.top)
+
+    report = {
+        'output_file'         : writer.file,
+        'mode'                : inventory_kind(),
+        'wall_clock_seconds'  : wall_clock,
+        'workers'             : workers,
+        'launch_configurations' : writer.launch_configurations,
+        'accounts'            : len(writer.accounts),
+        'regions'             : len(writer.regions),
+        'cache'               : cache_stats,
+        'latency_buckets'     : latency_buckets,
+        'apis'                : [dict(account_id=account_id, region=region, api=api, **stats) for (account_id, region, api), stats in sorted(api_stats.items(), key=str)],
+        'tasks'               : [dict(task=task, account_id=account_id, region=region, latency=histogram) for (task, account_id, region), histogram in sorted(task_stats.items(), key=str)],
+        'slowest_accounts'    : slowest_accounts,
+        'slowest_regions'     : slowest_regions
+    }
+
+    with open(file, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
 
     return
 
 # Outputs Summary of Inventory
-def write_summary(inventory):
+def write_summary(writer):
 
-    launch_configurations = 0
-    accounts = []
-    regions = []
+    logger.info('You have {} launch configurations across {} accounts and {} regions.'.format(writer.launch_configurations, len(writer.accounts), len(writer.regions)))
 
-    for item in inventory:
-        launch_configurations = launch_configurations + item['count']
-        if item['account_id'] not in accounts: accounts.append(item['account_id'])
-        if item['region'] not in regions: regions.append(item['region'])
+    if args.joined:
+        logger.info('{} launch configurations are not used by any Auto Scaling group or instance.'.format(writer.unused))
 
-    logger.info('You have {} launch configurations across {} accounts and {} regions.'.format(launch_configurations, len(accounts), len(regions)))
+    if writer.completed and args.resume:
+        logger.info('Accounts and regions saved by a previous run are not included in this summary.')
+
+    slowest_accounts, slowest_regions = get_slowest(args.top)
+    for account in slowest_accounts:
+        logger.info('Slowest account: {} took {:.2f} seconds.'.format(account['account_id'], account['seconds']))
+    for region in slowest_regions:
+        logger.info('Slowest region: {} in account {} took {:.2f} seconds.'.format(region['region'], region['account_id'], region['seconds']))
 
     return
 
-def main():
+# Gets Launch Configurations for a Single Account and Region
+# Region Scans Can Run Long After the Account Was Set Up, the Credential Provider Refreshes Itself When Needed
+def scan_region(account_id, region, credentials):
+    account_limiter.acquire(account_id)
+    region_limiter.acquire(region)
 
-    inventory = []
-    profile_name = args.profile
-    role_arn = args.role_arn
-    org_role_name = args.org_role_name
-    inventory_file = args.file
+    try:
+        if args.joined:
+            return timed('get_launch_configuration_usage', account_id, region, get_launch_configuration_usage, account_id, region, credentials)
+        elif args.in_use:
+            return timed('get_launch_configurations_in_use', account_id, region, get_launch_configurations_in_use, account_id, region, credentials)
+        else:
+            return timed('get_launch_configurations', account_id, region, get_launch_configurations, account_id, region, credentials)
 
-    # Get Credentials From Profile or Environment
-    credentials = None   
+    finally:
+        region_limiter.release(region)
+        account_limiter.release(account_id)
+
+# Gets Credentials and Regions for an Account, Then Queues a Scan for Each Region
+def scan_account(executor, checkpoint, snapshot, account_id, role_arn, credentials):
+
+    # Setup Session in Account
+    role_credentials = credentials
     if role_arn:
-        credentials = get_credentials_for_role(role_arn, None)
-    else:
-        credentials = get_credentials_for_profile(profile_name)
+        logger.info('Getting credentials to inventory account: {}'.format(account_id))
+        role_credentials = timed('get_credentials_for_role', account_id, None, get_credentials_for_role, role_arn, credentials)
 
-    if credentials is not None:
+        if role_credentials is None:
+            return None
 
-        # Inventorying Entire Organization
-        if args.org is True:
-            accounts = get_organization_accounts(credentials)
+    # Get List of Regions Enabled for Account, Skipping Regions Saved by a Previous Run
+    regions = timed('get_regions', account_id, None, get_regions, account_id, role_credentials)
+    if regions is None:
+        return None
+    if checkpoint is not None:
+        regions = [region for region in regions if not checkpoint.is_complete(account_id, region)]
+
+    # For Each Region Get Launch Configurations, Reusing Fresh Snapshots in Incremental Mode
+    region_scans = deque()
+    for region in regions:
+        if args.incremental and snapshot.is_fresh(account_id, region, inventory_kind()):
+            region_scans.append((executor.submit(snapshot.load, account_id, region, inventory_kind()), True))
+        else:
+            region_scans.append((executor.submit(scan_region, account_id, region, role_credentials), False))
 
-            # For Each Account, Attempt to Assume Role and Get Launch Configurations
-            for account in accounts:
-                account_id = account['Id']
-                logger.info('Inventorying account: {}'.format(account_id))
+    return region_scans
 
-                try: 
-                    # Setup Session in Account
-                    role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, org_role_name)
-                    logger.info('Getting credentials to inventory account: {}'.format(account_id))
-                    role_credentials = get_credentials_for_role(role_arn, credentials)
+# Snapshots Keep Rows of Each Inventory Mode Apart, as They Have Different Columns
+def inventory_kind():
+    if args.joined:
+        return 'joined'
+    return 'in_use' if args.in_use else 'all'
 
-                    if role_credentials is not None:
+# Writes a Change Detected Since the Last Snapshot to the Diff File
+def write_changes(diff_writer, data, changes):
+    for change, name in changes:
+        diff_writer.writerow([data['account_id'], data['region'], change, name])
+        logger.info('Launch configuration {} in account {} and region {}: {}'.format(name, data['account_id'], data['region'], change))
 
-                        # Get List of Regions Enabled for Account
-                        regions = get_regions(account_id, role_credentials)
+    return
 
-                        # For Each Region Get Launch Configurations
-                        for region in regions:
-                            if args.in_use:
-                                response = get_launch_configurations_in_use(account_id, region, role_credentials)
-                                inventory.append(response)
-                            else:
-                                response = get_launch_configurations(account_id, region, role_credentials)
-                                inventory.append(response)
+# Gets Whether an Account is in the Shard Being Scanned, the Hash is Stable Across Hosts and Processes
+def in_shard(account_id, shard):
+    if shard is None:
+        return True
 
-                # Catch and Store Errors
-                except ClientError as e:
-                        message = 'Error setting up session with account: {}'.format(e)
-                        logger.error(message)
+    index, count = shard
+    return int(hashlib.sha256(account_id.encode('utf-8')).hexdigest(), 16) % count == index
 
-        # Inventorying Single Account
-        if args.org is False:
+# Gets Credentials From a Role or Profile
+def get_credentials():
+    if args.role_arn:
+        return get_credentials_for_role(args.role_arn, None)
+    else:
+        return get_credentials_for_profile(args.profile)
+
+# Gets the Accounts to Scan and the Role Assumed in Each, None When Using the Credentials Directly
+def get_accounts_to_scan(credentials, checkpoint):
+
+    # Inventorying Entire Organization
+    if args.org is True:
+        accounts = get_organization_accounts(credentials)
+
+        # For Each Account, Attempt to Assume Role and Get Launch Configurations
+        for account in accounts:
+            account_id = account['Id']
+
+            if not in_shard(account_id, args.shard):
+                continue
+
+            if checkpoint is not None and checkpoint.is_complete(account_id):
+                logger.info('Skipping account saved by a previous run: {}'.format(account_id))
+                continue
+
+            logger.info('Inventorying account: {}'.format(account_id))
+
+            yield account_id, 'arn:aws:iam::{}:role/{}'.format(account_id, args.org_role_name)
 
-            try: 
-                account_id = boto3.client('sts', **credentials).get_caller_identity().get('Account')
+    # Inventorying Single Account
+    if args.org is False:
 
+        try: 
+            account_id = get_client(None, 'sts', None, credentials).get_caller_identity().get('Account')
+
+            if in_shard(account_id, args.shard):
                 logger.info('Getting inventory for account {}:'.format(account_id))
 
-                regions = get_regions(account_id, credentials)
+                yield account_id, None
+
+        except (ClientError, BotoCoreError) as e:
+                message = 'Error getting inventory, check your credential configuration or try with the -r argument: {}'.format(e)
+                logger.error(message)
+
+# Scans Every Account and Region, Yielding (Row, From Snapshot) Pairs in Account and Region Order
+# Accounts Whose Regions All Succeed are Marked Complete in the Checkpoint Once Their Rows are Consumed
+def scan_partitions(credentials, checkpoint=None, snapshot=None):
+
+    # Only a Bounded Window of Accounts is in Flight, Each Account is Dropped Once its Rows are Yielded,
+    # so Memory Depends on the Number of Workers Rather Than the Size of the Organization
+    scans = deque()
+    window = args.workers * default_accounts_per_worker
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    accounts = get_accounts_to_scan(credentials, checkpoint)
 
-                # For Each Region Get Launch Configurations
-                for region in regions:
-                    if args.in_use:
-                        response = get_launch_configurations_in_use(account_id, region, credentials)
-                        inventory.append(response)
+    def submit_accounts():
+        while len(scans) < window:
+            account = next(accounts, None)
+            if account is None:
+                return
+            account_id, role_arn = account
+            scans.append((account_id, role_arn, executor.submit(scan_account, executor, checkpoint, snapshot, account_id, role_arn, credentials)))
+
+    try:
+        submit_accounts()
+
+        # Yield Results in Account and Region Order as They Complete, Regardless of Completion Order
+        while scans:
+            account_id, role_arn, account_scan = scans.popleft()
+            submit_accounts()
+            try:
+                region_scans = account_scan.result()
+                if region_scans is None:
+                    continue
+
+                # Regions That Failed are Not Journaled, so a Resumed Scan Retries Them
+                account_complete = True
+                while region_scans:
+                    region_scan, from_snapshot = region_scans.popleft()
+                    response = region_scan.result()
+                    if response:
+                        yield response, from_snapshot
                     else:
-                        response = get_launch_configurations(account_id, region, credentials)
-                        inventory.append(response)
+                        account_complete = False
 
-            except ClientError as e:
-                    message = 'Error getting inventory, check your credential configuration or try with the -r argument: {}'.format(e)
+                if account_complete and checkpoint is not None:
+                    checkpoint.mark_complete(account_id)
+
+            # Catch and Store Errors, the Account is Not Journaled so a Resumed Scan Retries it
+            except (ClientError, BotoCoreError) as e:
+                    message = 'Error setting up session with account {}: {}'.format(account_id, e)
                     logger.error(message)
 
+            finally:
+                del account_scan
+                release_account(account_id, role_arn)
+
+    # Stop Queued Scans When Finished, on Errors, or When the Caller Stops Consuming Rows
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Scans Launch Configurations and Yields One Row per Account and Region, in Account and Region Order
+# Options are the Command Line Arguments as Keywords, for Example scan(org=True, org_role_name='ROLE_NAME', workers=16)
+# With snapshot the Snapshot is Updated as in main() and incremental Yields Fresh Partitions From it, No Output or Diff File is Written
+# Caches and Counters are Shared by the Module, so Only One Scan Can Run at a Time in a Process
+def scan(**kwargs):
+    options = parser.parse_args([])
+    for name, value in kwargs.items():
+        if not hasattr(options, name):
+            raise TypeError('Unknown scan option: {}'.format(name))
+        setattr(options, name, value)
+
+    # The Checkpoint Journal Belongs to the Output File, Which Only main() Writes
+    if options.resume:
+        raise ValueError('resume is only supported by main(), which writes the output file and its checkpoint')
+
+    error = check_args(options)
+    if error:
+        raise ValueError(error)
+
+    configure(options)
+
+    credentials = get_credentials()
+    if credentials is None:
+        raise ValueError('No credentials to perform inventory.')
+
+    snapshot = InventorySnapshot(options.snapshot, options.max_age) if options.snapshot else None
+    try:
+        for response, from_snapshot in scan_partitions(credentials, snapshot=snapshot):
+            if snapshot and not from_snapshot:
+                snapshot.record(response, inventory_kind())
+            yield response
+    finally:
+        if snapshot:
+            snapshot.close()
+
+def main(argv=None):
+
+    configure(parse_args(argv))
+    configure_logging()
+
+    inventory_file = args.file
+    start = time.perf_counter()
+
+    # Get Credentials From Profile or Environment
+    credentials = get_credentials()
+
+    if credentials is not None:
+
+        writer = InventoryWriter(inventory_file, args.format, args.resume)
+
+        # Snapshot Changes are Reported Alongside the Inventory
+        snapshot = None
+        diff_file = None
+        diff_writer = None
+        changes_found = 0
+        if args.snapshot:
+            snapshot = InventorySnapshot(args.snapshot, args.max_age)
+            diff_exists = args.resume and os.path.exists(args.diff_file) and os.path.getsize(args.diff_file) > 0
+            diff_file = open(args.diff_file, 'a' if args.resume else 'w', newline='')
+            diff_writer = csv.writer(diff_file)
+            if not diff_exists:
+                diff_writer.writerow(['account_id', 'region', 'change', 'launch_configuration'])
+
+        try:
+            for response, from_snapshot in scan_partitions(credentials, writer, snapshot):
+                writer.write(response)
+
+                # Only Newly Scanned Partitions Update the Snapshot
+                if snapshot and not from_snapshot:
+                    changes = snapshot.record(response, inventory_kind())
+                    write_changes(diff_writer, response, changes)
+                    diff_file.flush()
+                    changes_found = changes_found + len(changes)
+
+        # Everything Written so Far Can be Resumed
+        except BaseException:
+            logger.error('Scan interrupted, run again with --resume to continue from the checkpoint file: {}'.format(writer.checkpoint_file))
+            raise
+
+        finally:
+            writer.close()
+            if snapshot:
+                snapshot.close()
+                diff_file.close()
 
         # Write Outputs
-        write_inventory_file(inventory_file, inventory)
-        write_summary(inventory)
-        return inventory
+        write_summary(writer)
+        if snapshot:
+            logger.info('Found {} changes since the last snapshot, saved to diff file: {}'.format(changes_found, args.diff_file))
+        wall_clock = time.perf_counter() - start
+        write_timings(wall_clock, args.workers)
+        write_report('{}.report.json'.format(inventory_file), writer, wall_clock, args.workers)
+        return writer
 
     else:
         logger.error("No credentials to perform inventory.")
@@ -0,0 +1,320 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Runs the Inventory Against the Simulated Organization of benchmark.py, Without Calling AWS
+# Usage: python3 -m pytest test_inventory.py
+
+import csv
+import datetime
+import gzip
+import json
+import os
+
+import boto3
+import pytest
+from botocore.exceptions import BotoCoreError
+
+import benchmark
+import inventory
+
+@pytest.fixture
+def organization(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', benchmark.management_access_key)
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'simulated')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_CONFIG_FILE', os.devnull)
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', os.devnull)
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    monkeypatch.delenv('AWS_SESSION_TOKEN', raising=False)
+
+    boto3.setup_default_session()
+    organization = benchmark.SimulatedOrganization({
+        'accounts'              : 3,
+        'regions'               : 2,
+        'launch_configurations' : 2,
+        'auto_scaling_groups'   : 2,
+        'instances'             : 1,
+        'page_size'             : 50,
+        'latency'               : 0,
+        'throttle_rate'         : 0,
+        'seed'                  : benchmark.default_seed
+    })
+    organization.register(boto3.DEFAULT_SESSION)
+
+    # The Simulated STS Uses a Clock the Test Moves Forward
+    clock = {'now': datetime.datetime.now(datetime.timezone.utc)}
+    organization.now = lambda: clock['now']
+    organization.clock = clock
+
+    yield organization
+
+    boto3.DEFAULT_SESSION = None
+
+def configure(argv):
+    inventory.configure(inventory.parse_args(argv))
+
+# Makes a Credential Provider Read the Simulated Clock When Deciding Whether to Refresh
+def use_clock(credentials, organization):
+    credentials._time_fetcher = organization.now
+    return credentials
+
+# Records Completed Accounts Like the Checkpoint Journal of InventoryWriter
+class Checkpoint:
+
+    def __init__(self):
+        self.completed = set()
+
+    def is_complete(self, account_id, region='*'):
+        return (account_id, region) in self.completed
+
+    def mark_complete(self, account_id, region='*'):
+        self.completed.add((account_id, region))
+
+def count_calls(organization, operation_name):
+    return sum(count for (account_id, region, name, token), count in organization.calls.items() if name == operation_name)
+
+# Stops a Scan Part Way Through Writing a Partition, Leaving What a Killed Process Would on Disk
+class Crash(BaseException):
+    pass
+
+def crash_on_write(monkeypatch, writes):
+    write = inventory.InventoryWriter.write
+    calls = []
+
+    def crashing_write(self, data):
+        calls.append(data)
+        if len(calls) == writes:
+            if self.output_format == 'jsonl':
+                self.data_file.write(gzip.compress(b'{"account_id": "partial"}\n')[:12])
+            else:
+                self.data_file.write('{},{}'.format(data['account_id'], data['region'][:4]))
+            self.data_file.flush()
+            raise Crash()
+        return write(self, data)
+
+    monkeypatch.setattr(inventory.InventoryWriter, 'write', crashing_write)
+
+def read_partitions(file, output_format):
+    if output_format == 'jsonl':
+        with gzip.open(file, 'rt', encoding='utf-8') as data_file:
+            return [(record['account_id'], record['region']) for record in map(json.loads, data_file)]
+    with open(file, newline='') as data_file:
+        return [(row['account_id'], row['region']) for row in csv.DictReader(data_file)]
+
+@pytest.mark.parametrize('output_format', ['csv', 'jsonl'])
+def test_crashed_scan_is_resumed(organization, monkeypatch, tmp_path, output_format):
+    organization.config['launch_configurations'] = 1
+    file = str(tmp_path / 'inventory.{}'.format(output_format))
+    argv = ['-o', '-or', 'SimulatedRole', '-w', '1', '-fo', output_format, '-f', file]
+
+    with monkeypatch.context() as crash:
+        crash_on_write(crash, 4)
+        with pytest.raises(Crash):
+            inventory.main(argv)
+
+    inventory.main(argv + ['-re'])
+
+    expected = [(account_id, region) for account_id in organization.accounts for region in organization.regions]
+    assert sorted(read_partitions(file, output_format)) == sorted(expected)
+
+def test_resumed_scan_skips_saved_partitions(organization, monkeypatch, tmp_path):
+    argv = ['-o', '-or', 'SimulatedRole', '-w', '1', '-f', str(tmp_path / 'inventory.csv')]
+    partitions = [(account_id, region) for account_id in organization.accounts for region in organization.regions]
+
+    with monkeypatch.context() as crash:
+        crash_on_write(crash, 4)
+        with pytest.raises(Crash):
+            inventory.main(argv)
+
+    def first_pages(calls):
+        return [calls.get(partition + ('DescribeLaunchConfigurations', None), 0) for partition in partitions]
+
+    before = first_pages(dict(organization.calls))
+    inventory.main(argv + ['-re'])
+    after = first_pages(organization.calls)
+
+    # Partitions are Written in Account and Region Order, so the First Three Were Saved Before the Crash
+    assert [partition for partition, old, new in zip(partitions, before, after) if new != old] == partitions[3:]
+
+def test_snapshot_reports_changes_since_the_last_scan(organization, tmp_path):
+    diff_file = tmp_path / 'inventory-diff.csv'
+    argv = ['-o', '-or', 'SimulatedRole', '-f', str(tmp_path / 'inventory.csv'), '-s', str(tmp_path / 'inventory.db'), '-d', str(diff_file)]
+
+    # The First Scan Only Establishes a Baseline
+    inventory.main(argv)
+    with open(diff_file, newline='') as changes:
+        assert list(csv.DictReader(changes)) == []
+
+    organization.config['launch_configurations'] = 3
+    inventory.main(argv)
+
+    with open(diff_file, newline='') as changes:
+        rows = [(row['account_id'], row['region'], row['change'], row['launch_configuration']) for row in csv.DictReader(changes)]
+    assert sorted(rows) == sorted(
+        (account_id, region, 'added', 'lc-{}-2'.format(region)) for account_id in organization.accounts for region in organization.regions
+    )
+
+def test_incremental_scan_only_rescans_stale_partitions(organization, tmp_path):
+    argv = ['-o', '-or', 'SimulatedRole', '-f', str(tmp_path / 'inventory.csv'), '-s', str(tmp_path / 'inventory.db'), '-d', str(tmp_path / 'inventory-diff.csv'), '-in']
+
+    inventory.main(argv)
+    calls = count_calls(organization, 'DescribeLaunchConfigurations')
+    writer = inventory.main(argv)
+
+    assert count_calls(organization, 'DescribeLaunchConfigurations') == calls
+    assert writer.launch_configurations == len(organization.accounts) * len(organization.regions) * organization.config['launch_configurations']
+
+@pytest.mark.parametrize('output_format', ['jsonl', 'parquet'])
+def test_records_are_written_per_launch_configuration(organization, tmp_path, output_format):
+    if output_format == 'parquet':
+        parquet = pytest.importorskip('pyarrow.parquet')
+    file = str(tmp_path / 'inventory.{}'.format(output_format))
+
+    inventory.main(['-o', '-or', 'SimulatedRole', '-fo', output_format, '-f', file])
+
+    if output_format == 'jsonl':
+        with gzip.open(file, 'rt', encoding='utf-8') as data_file:
+            records = [json.loads(line) for line in data_file]
+    else:
+        records = parquet.read_table(file).to_pylist()
+
+    assert sorted((record['account_id'], record['region'], record['launch_configuration']) for record in records) == sorted(
+        (account_id, region, 'lc-{}-{}'.format(region, index))
+        for account_id in organization.accounts for region in organization.regions
+        for index in range(organization.config['launch_configurations'])
+    )
+
+def test_parent_role_is_refreshed_before_member_role(organization):
+    configure(['-o', '-or', 'SimulatedRole', '-r', 'arn:aws:iam::{}:role/SimulatedRole'.format(benchmark.management_account_id)])
+
+    parent = use_clock(inventory.get_credentials(), organization)
+    member_account = organization.accounts[1]
+    member = use_clock(inventory.get_credentials_for_role('arn:aws:iam::{}:role/SimulatedRole'.format(member_account), parent), organization)
+    assert inventory.get_regions(member_account, member) == organization.regions
+
+    first_parent_key = parent.access_key
+    first_member_key = member.access_key
+
+    # Both Sessions Expire, a Member Role Assumed With the Old Parent Credentials Would Get ExpiredToken
+    organization.clock['now'] += datetime.timedelta(minutes=70)
+
+    assert inventory.get_regions(member_account, member) == organization.regions
+    assert parent.access_key != first_parent_key
+    assert member.access_key != first_member_key
+    assert inventory.cache_stats['credentials_assumed'] == 4
+
+def test_single_account_role_is_refreshed(organization):
+    configure(['-r', 'arn:aws:iam::{}:role/SimulatedRole'.format(organization.accounts[0])])
+
+    credentials = use_clock(inventory.get_credentials(), organization)
+    first_key = credentials.access_key
+
+    organization.clock['now'] += datetime.timedelta(minutes=70)
+
+    rows = list(inventory.scan_partitions(credentials))
+    assert [row['region'] for row, from_snapshot in rows] == organization.regions
+    assert credentials.access_key != first_key
+
+def test_failed_region_is_not_checkpointed(organization, monkeypatch, caplog):
+    configure(['-r', 'arn:aws:iam::{}:role/SimulatedRole'.format(organization.accounts[0])])
+    failed_region = organization.regions[1]
+    describe_launch_configurations = organization.DescribeLaunchConfigurations
+
+    # Not a ClientError, and Not One of the Connection Errors That are Retried
+    def fail_in_region(account_id, region, params):
+        if region == failed_region:
+            raise BotoCoreError()
+        return describe_launch_configurations(account_id, region, params)
+
+    monkeypatch.setattr(organization, 'DescribeLaunchConfigurations', fail_in_region)
+    checkpoint = Checkpoint()
+
+    rows = list(inventory.scan_partitions(inventory.get_credentials(), checkpoint))
+    assert [row['region'] for row, from_snapshot in rows] == organization.regions[:1]
+    assert checkpoint.completed == set()
+    assert len([record for record in caplog.records if record.levelname == 'ERROR']) == 1
+
+def test_account_is_not_checkpointed_when_regions_fail(organization, monkeypatch):
+    configure(['-r', 'arn:aws:iam::{}:role/SimulatedRole'.format(organization.accounts[0])])
+
+    def fail(account_id, region, params):
+        raise BotoCoreError()
+
+    monkeypatch.setattr(organization, 'DescribeRegions', fail)
+    checkpoint = Checkpoint()
+
+    assert list(inventory.scan_partitions(inventory.get_credentials(), checkpoint)) == []
+    assert checkpoint.completed == set()
+
+def test_throttles_do_not_depend_on_workers(organization, monkeypatch):
+    organization.config['throttle_rate'] = 0.2
+    monkeypatch.setattr(inventory.random, 'uniform', lambda low, high: 0)
+
+    throttles = []
+    for workers in ['1', '8']:
+        organization.calls.clear()
+        configure(['-o', '-or', 'SimulatedRole', '-w', workers])
+        rows = list(inventory.scan_partitions(inventory.get_credentials()))
+        assert len(rows) == len(organization.accounts) * len(organization.regions)
+        throttles.append({key: stats['throttles'] for key, stats in inventory.api_stats.items()})
+
+    assert sum(throttles[0].values()) > 0
+    assert throttles[0] == throttles[1]
+
+def test_only_in_service_instances_are_counted(organization, monkeypatch):
+    organization.config['instances'] = 2
+    organization.config['auto_scaling_groups'] = 1
+    describe_auto_scaling_groups = organization.DescribeAutoScalingGroups
+
+    # The Second Instance of Every Group is Still Launching
+    def with_pending_instance(account_id, region, params):
+        response = describe_auto_scaling_groups(account_id, region, params)
+        for auto_scaling_group in response['AutoScalingGroups']:
+            auto_scaling_group['Instances'][1]['LifecycleState'] = 'Pending'
+        return response
+
+    monkeypatch.setattr(organization, 'DescribeAutoScalingGroups', with_pending_instance)
+    configure(['-r', 'arn:aws:iam::{}:role/SimulatedRole'.format(organization.accounts[0]), '-j'])
+
+    rows = list(inventory.scan_partitions(inventory.get_credentials()))
+    launch_configurations = {item['launch_configuration']: item for row, from_snapshot in rows for item in row['launch_configuratons']}
+
+    in_use = launch_configurations['lc-{}-0'.format(organization.regions[0])]
+    assert in_use['instances'] == 1
+    assert in_use['unused'] is False
+    assert launch_configurations['lc-{}-1'.format(organization.regions[0])]['unused'] is True
+
+def test_incremental_scan_reuses_the_snapshot(organization, tmp_path):
+    options = {'role_arn': 'arn:aws:iam::{}:role/SimulatedRole'.format(organization.accounts[0]), 'snapshot': str(tmp_path / 'inventory.db'), 'incremental': True}
+
+    first = list(inventory.scan(**options))
+    calls = count_calls(organization, 'DescribeLaunchConfigurations')
+    second = list(inventory.scan(**options))
+
+    assert [row['region'] for row in first] == organization.regions
+    assert [row['launch_configuratons'] for row in second] == [row['launch_configuratons'] for row in first]
+    assert count_calls(organization, 'DescribeLaunchConfigurations') == calls
+
+def test_scan_rejects_resume(organization):
+    with pytest.raises(ValueError):
+        list(inventory.scan(resume=True))
+
+def test_shards_partition_the_accounts(organization):
+    shards = [[(row['account_id'], row['region']) for row in inventory.scan(org=True, org_role_name='SimulatedRole', shard=(index, 3))] for index in range(3)]
+
+    scanned = [partition for shard in shards for partition in shard]
+    assert sorted(scanned) == sorted((account_id, region) for account_id in organization.accounts for region in organization.regions)
+    assert all(inventory.in_shard(account_id, (index, 3)) for index, shard in enumerate(shards) for account_id, region in shard)
+    assert inventory.parse_args(['-sh', '1/3']).file == 'inventory-shard-1-of-3.csv'